@@ -0,0 +1,166 @@
+"""
+Keeps annotations in an indexed SQLite database.
+
+Every annotation is stored with the label of its equation, so other
+tools can find all of the annotations on a set of equations without
+reading any TeX. The module can also be run directly:
+
+    python annotation_store.py database add texfile [texfile ...]
+    python annotation_store.py database find pattern
+
+Where `add` stores every annotation comment already inserted in the
+given TeX files and `find` prints the annotations on every equation
+whose label matches `pattern` (e.g. "eq:ZE.EX.*").
+
+Files are stored by their absolute path. The offsets stored with an
+annotation are those of the sentence it was found in (in the input
+file) when it comes from `find_annotations.py --store`, and those of
+its comment (in the processed file) when it comes from `add`; which
+one they are is stored with them.
+"""
+
+from __future__ import print_function
+
+import re
+import os
+import sys
+import sqlite3
+from collections import namedtuple
+
+from utilities import readin
+
+#an annotation and where it came from (sentence and offsets may be None, offsets says what start and end are offsets of)
+AnnotationRecord = namedtuple("AnnotationRecord", "file label type annotation sentence start end offsets")
+
+#offsets of the sentence the annotation was found in, in the input file
+SENTENCE_OFFSETS = "sentence"
+
+#offsets of the annotation comment, in the processed file
+COMMENT_OFFSETS = "comment"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    file TEXT NOT NULL,
+    label TEXT NOT NULL,
+    type TEXT NOT NULL,
+    annotation TEXT NOT NULL,
+    sentence INTEGER,
+    start_offset INTEGER,
+    end_offset INTEGER,
+    offsets TEXT,
+    PRIMARY KEY (file, label, type, annotation)
+);
+CREATE INDEX IF NOT EXISTS annotations_label ON annotations (label);
+"""
+
+#columns in the order of the AnnotationRecord fields
+_COLUMNS = ("file", "label", "type", "annotation", "sentence", "start_offset", "end_offset", "offsets")
+
+#matches an equation along with its label
+_equation_pat = re.compile(r'\\begin{equation}\\label{(?P<label>eq:.*?)}(?P<body>.*?)\\end{equation}', re.DOTALL)
+
+#matches an annotation comment inside an equation
+_comment_pat = re.compile(r'^%\s*\\(?P<type>constraint|substitution|drmfname|drmfnote|proof){(?P<annotation>.*)}\s*$', re.MULTILINE)
+
+def main():
+
+    if len(sys.argv) < 4 or sys.argv[2] not in ("add", "find"):
+
+        print("Usage: {0} <database> add <texfile> [<texfile> ...]".format(sys.argv[0]))
+        print("       {0} <database> find <pattern>".format(sys.argv[0]))
+        sys.exit(-1)
+
+    store = AnnotationStore(sys.argv[1])
+
+    #store the annotations in every file
+    if sys.argv[2] == "add":
+
+        for fname in sys.argv[3:]:
+            store.upsert(read_annotations(fname, readin(fname)))
+
+    #print every matching annotation
+    else:
+
+        for record in store.find(sys.argv[3]):
+            print("{0}\t{1}\t{2}\t{3}".format(record.label, record.type, record.annotation, record.file))
+
+    store.close()
+
+class AnnotationStore(object):
+    """
+    SQLite database of `AnnotationRecord`s, indexed by equation label.
+    """
+
+    def __init__(self, filename):
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_SCHEMA)
+
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(annotations)")]
+
+        #databases made before the kind of offsets was stored
+        if "offsets" not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE annotations ADD COLUMN offsets TEXT")
+
+    def upsert(self, records):
+        """
+        Adds every record in `records`, replacing any that are already stored.
+
+        A record is replaced when its file, label, type and annotation
+        are all the same as one that is already in the database. Files
+        are stored by their absolute path, so the same file is the same
+        whichever directory it was given from. All of the records are
+        added in one transaction.
+        """
+
+        records = [record._replace(file=os.path.abspath(record.file)) for record in records]
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+
+    def find(self, pattern):
+        """
+        Returns a list of the records whose label matches glob `pattern`.
+
+        Everything before the first wildcard is used as a prefix, so
+        only the part of the label index that starts with it is read.
+        """
+
+        prefix = re.split(r'[*?[]', pattern, 1)[0]
+
+        query = "SELECT {0} FROM annotations WHERE label GLOB ?".format(", ".join(_COLUMNS))
+        params = [pattern]
+
+        #narrow the search down to the labels starting with prefix
+        if prefix:
+            query += " AND label >= ? AND label < ?"
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+        query += " ORDER BY label, file"
+
+        return [AnnotationRecord(*row) for row in self.connection.execute(query, params)]
+
+    def close(self):
+        self.connection.close()
+
+def read_annotations(fname, content):
+    """
+    Returns a list of `AnnotationRecord`s for the annotation comments in `content`.
+    """
+
+    records = []
+
+    #find the comments in each equation
+    for eq_match in _equation_pat.finditer(content):
+
+        body_start = eq_match.start("body")
+
+        for match in _comment_pat.finditer(eq_match.group("body")):
+            records.append(AnnotationRecord(fname, eq_match.group("label"), match.group("type"), match.group("annotation"),
+                                            None, body_start + match.start(), body_start + match.end(), COMMENT_OFFSETS))
+
+    return records
+
+if __name__ == "__main__":
+    main()
@@ -8,16 +8,54 @@ after they have processed it manually.
 import re
 import sys
 import os
-from collections import namedtuple, OrderedDict
-
-from utilities import (readin, writeout, get_input, get_last_line)
-
-#default name for the progress file
+import json
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple, OrderedDict, Counter
+
+from utilities import (readin, writeout, writeout_atomic, iter_chunks,
+                       iter_patch, get_input, get_last_line, SentenceTable,
+                       LabelTrie, SuggestionIndex, PositionIndex, readline,
+                       save_snapshot, load_snapshot, remove_inner_whitespace,
+                       REM_START, REM_END)
+from annotation_store import AnnotationStore, AnnotationRecord, SENTENCE_OFFSETS
+from label_index import LabelIndex
+from session import Session, SessionLocked, STATE_DIR, clean_stale_sessions
+from indicator_stats import IndicatorStats
+from validator import validate, format_problems
+from scanner import (AnnotationScanner, Candidate, DocumentIndex, BOUNDARY_TOKENS,
+                     SECTION_LEVELS, index_document, section_level, math_spans,
+                     line_indicator, line_position, cluster_key,
+                     MAX_SCAN_SECONDS)
+
+#name of the progress file in the session directory
 PROGRESS_FILE = ".bookmark"
 
-#default name for the save file
+#name of the save file in the session directory
 SAVE_FILE = ".save"
 
+#name of the snapshot of the parsed save file in the session directory
+SNAPSHOT_FILE = ".snapshot"
+
+#name of the file of skipped and deleted sentences in the session directory
+NAVIGATION_FILE = ".navigation"
+
+#name of the file of past annotation texts shared by every session
+HISTORY_FILE = "history"
+
+#name of the file of indicator precision shared by every session
+STATS_FILE = "indicators.json"
+
+#name of the report of sentences that took too long to scan in the session directory
+METRICS_FILE = "metrics"
+
+#number of lines shown on each side of the flagged line
+CONTEXT_LINES = 10
+
+#most labels listed when an unknown label is entered
+MAX_LISTED_LABELS = 20
+
 #remap input and range functions for python 3
 if int(sys.version[0]) >= 3:
     raw_input = input
@@ -26,23 +64,49 @@ if int(sys.version[0]) >= 3:
 #class to represent the user's response to an annotation query
 InputResponse = namedtuple("InputResponse", "type annotation equations")
 
+#name of the comment for each type of annotation
+ANNOTATION_TYPES = {
+    "c": "constraint",
+    "s": "substitution",
+    "m": "drmfname",
+    "n": "drmfnote",
+    "p": "proof"
+}
+
 def main():
 
-    if len(sys.argv) != 3:
+    parser = argparse.ArgumentParser(description="Finds annotations in TeX source and puts them in equations.")
 
-        print("Usage: {0} <inputfile> <outputfile>".format(sys.argv[0]))
-        sys.exit(-1)
+    parser.add_argument("inputfile", help="file containing the TeX source to process")
+    parser.add_argument("outputfile", help="file to write the processed TeX to")
+    parser.add_argument("--patch", action="store_true", help="write a unified diff of the changes instead of the whole document")
+    parser.add_argument("--store", metavar="DATABASE", help="also add the annotations to this SQLite database")
+    parser.add_argument("--index", metavar="INDEXFILE", help="label index (from label_index.py) used to find equations in other files")
+    parser.add_argument("--batch", metavar="N", type=int, default=0, help="review about N possible annotations at a time before entering them")
+    parser.add_argument("--min-precision", metavar="P", type=float, default=0.0, help="don't look for indicators that fewer than this fraction of the lines found by were annotations")
+    parser.add_argument("--scan-time", metavar="SECONDS", type=float, default=MAX_SCAN_SECONDS, help="most time spent finding the context of one sentence before showing it with less context")
+    parser.add_argument("--state-dir", metavar="DIR", default=STATE_DIR, help="directory the progress of each input file is kept in")
 
-    else:
+    args = parser.parse_args()
 
-        fname = sys.argv[1]
-        ofname = sys.argv[2]
+    fname = args.inputfile
+    ofname = args.outputfile
 
     options = {"resume": False, "append": False, "start": 0, "offset": 0}
 
+    #progress is kept separately for each input file
+    clean_stale_sessions(args.state_dir)
+    session = Session(fname, args.state_dir)
+
+    try:
+        session.acquire()
+    except SessionLocked as error:
+        print(str(error).upper())
+        sys.exit(-1)
+
     #if file does not exist, no endline
     try:
-        endline = get_last_line(PROGRESS_FILE)
+        endline = get_last_line(session.path(PROGRESS_FILE))
     except IOError:
         endline = "" 
     
@@ -63,6 +127,19 @@ def main():
     if not options["resume"]:
         options["start"] = 0
 
+    options["input"] = fname
+    options["session"] = session
+    options["batch"] = args.batch
+    options["stats"] = IndicatorStats(session.shared_path(STATS_FILE))
+    options["min_precision"] = args.min_precision
+    options["scan_time"] = args.scan_time
+    options["store"] = args.store
+    options["corpus"] = None
+
+    #equations from other files are looked up in the label index
+    if args.index:
+        options["corpus"] = LabelIndex(args.index)
+
     in_tex = readin(fname)
 
     #read in from save file if resuming
@@ -70,16 +147,35 @@ def main():
 
         #read in from save file if it exists
         try:
-            in_tex = readin(SAVE_FILE)
+            in_tex = readin(session.path(SAVE_FILE))
         except IOError:
             print("NO SAVE FILE PRESENT - STARTING OVER")
             options["resume"] = False
+
+    #reuse the parsed save file if it was saved along with it
+    if options["resume"]:
+        options["document"] = load_document(session.path(SNAPSHOT_FILE), in_tex, options["start"])
+
+    options["navigation"] = {"skipped": [], "marked": []}
+
+    #remember what was skipped and deleted before
+    if options["resume"]:
+        options["navigation"] = load_navigation(session.path(NAVIGATION_FILE))
     
     output = find_annotations(in_tex, **options)
 
     #only write out if we haven't already done so (user didn't quit)
     if output is not None:
-        writeout(ofname, output)
+
+        #only write what changed if the user asked for a patch
+        if args.patch:
+            chunks = iter_patch(readin(fname), output, fname, ofname)
+        else:
+            chunks = iter_chunks(output)
+
+        writeout_atomic(ofname, chunks)
+
+    session.release()
  
 def find_annotations(content, **options):
     """
@@ -90,254 +186,225 @@ def find_annotations(content, **options):
     Returns an updated version of content.
     """
     
-    indicators = [
-        "When", 
-        "Where", 
-        "If", 
-        "Then", 
-        "For", 
-        "With", 
-        "As", 
-        "Throughout", 
-        "In",
-        "Over"
-    ]
-
-    indicators.extend([indicator.lower() for indicator in indicators])
-
-    sentence_pat = re.compile(r'([^.!?\s][^.!?]*(?:[.!?](?!\s|$)[^.!?]*)*[.!?]?(?=\s|$))', re.DOTALL)
- 
-    label_pat = re.compile(r'\\(?:label|eqref){(?P<eq_id>eq:.*?)}')
-    eq_range_pat = re.compile(r'\\eqref{(?P<start>eq:(?P<main_name>.*?\..*?\..*?).+?)}\s*--\s*\\eqref{(?P<end>eq:.*?)}')
-    definition_pat = re.compile(r'\$(?P<var_name>.)\$ defined by \\eqref{(?P<eq_id>.*?)}')
+    #index of the equations in other files (if there is one)
+    corpus = options.get("corpus")
 
-    responses = OrderedDict()
+    scanner = options.get("scanner") or AnnotationScanner(corpus=corpus, max_seconds=options.get("scan_time", MAX_SCAN_SECONDS))
 
-    doc_start = content.find("\\begin{document}")
-    
-    every_sentence = list(sentence_pat.finditer(content[doc_start:]))
-    num_sentences = len(every_sentence)
+    #how often the lines each indicator found were annotations
+    stats = options.get("stats") or IndicatorStats()
+    min_precision = options.get("min_precision", 0.0)
 
-    rem_offset = doc_start
-    start = 0
+    #try the most precise indicators first
+    if stats.counts:
 
-    #set offset and start
-    if options["resume"]:
-        start = options["start"]    
+        print("Indicator precision:\n{0}".format(stats.summary(scanner.indicators, min_precision)))
 
-    #go through each sentence
-    for snum, sentence_match in enumerate(every_sentence):
+        scanner.set_indicators(stats.order(scanner.indicators, min_precision))
 
-        #don't start till we get to starting point
-        if snum < start:
-            continue
+    responses = OrderedDict()
 
-        assoc_equations = []
-        annotation_lines = []
+    document = options.get("document")
 
-        sentence = sentence_match.group()
+    #only parse the document if we didn't get it from a snapshot
+    if document is None:
+        document = scanner.index(content)
 
-        before = ""
+    #offsets in the index are into the content we started with
+    source = content
 
-        #this isn't the first sentence, get the previous sentence
-        if snum != 0:
-            before = every_sentence[snum - 1].group()
+    equations = document.equations
 
-        after = ""
+    #labels of the equations annotations can be put in, for completing and checking labels
+    #(equations in other files are only used for context)
+    labels = LabelTrie(equations)
 
-        #this isn't the last sentence, get the next sentence
-        if snum != num_sentences - 1:
-            after = every_sentence[snum + 1].group()
+    #texts of the annotations entered in this and earlier sessions
+    suggestions = SuggestionIndex()
 
-        sentence = sentence.strip()
-        sentence = re.sub(r'\n{2,}', r'\n', sentence)
+    if options.get("session") is not None:
+        suggestions = SuggestionIndex.from_file(options["session"].shared_path(HISTORY_FILE))
 
-        sectioning = "" 
+    every_sentence = document.sentences
+    num_sentences = len(every_sentence)
 
-        #see if the section or subsection is referenced
-        if "this subsection" in sentence:
-            sectioning = "subsection"
-        if "this section" in sentence:
-            sectioning = "section"
-        if "this chapter" in sentence:
-            sectioning = "chapter"
+    start = 0
 
-        #either the seciton or subsection was referenced
-        if sectioning:
+    #set offset and start
+    if options["resume"]:
+        start = options["start"]    
 
-            before = ""
-            sentence = sentence[sentence.find("\\" + sectioning):]
+    #cluster keys of the lines of each sentence that will be asked about (found without building any context)
+    sentence_keys = [[cluster_key(line) for line, line_loc in scanner.scan_lines(document, snum)] for snum in xrange(num_sentences)]
 
-            line_ind = snum + 2
+    #how many lines there are like each line in the sentences not reached yet
+    cluster_sizes = _count_clusters(sentence_keys, start)
 
-            #keep adding sentences to after
-            while (line_ind < num_sentences
-                and ("\\" + sectioning) not in after):
+    #answers the user gave for a whole cluster of lines
+    cluster_answers = {}
 
-                after = ''.join([after, every_sentence[line_ind].group()])
-                line_ind += 1
+    #lines accepted or rejected in batch review, and the last sentence reviewed
+    batch_size = options.get("batch", 0)
+    batch_answers = {}
+    batch_end = start - 1
 
-            to_join = []
+    #scans of the sentences in the batch that haven't been reached yet
+    batch_scans = {}
 
-            after_lines = after.split("\n")
-            line_ind = 0
-            current = after_lines[line_ind] 
- 
-            #keep adding lines until the start of the next section
-            while (("\\" + sectioning) not in current
-                and line_ind + 1 < len(after_lines)):
+    #sentences skipped over and marked for deletion (kept with the session)
+    navigation = options.setdefault("navigation", {"skipped": [], "marked": []})
+    marked = set(navigation["marked"])
 
-                to_join.append(current)
+    #original offset and length of every marker put in content, in order
+    insertions = []
 
-                line_ind += 1
-                current = after_lines[line_ind] 
+    next_snum = start
 
-            to_join.append(current)
-            
-            after = '\n'.join(to_join)
+    #go through each sentence, starting from the starting point (until the user goes elsewhere)
+    while next_snum < num_sentences:
 
-        found_range = False
+        snum = next_snum
+        next_snum = snum + 1
 
-        #include ranges of equations if they are referenced
-        for match in eq_range_pat.finditer(sentence):
-  
-            found_range = True
+        sentence_match = every_sentence[snum]
+        options["cursor"] = snum
 
-            current = snum + 2
-            start_id = match.group("start")
-            end_id = match.group("end")
-            main_name = match.group("main_name")
-            
-            #keep adding to after until we have the whole range
-            while (current < num_sentences
-                and r'\label{' + end_id + '}' not in after):
+        cluster_sizes.subtract(sentence_keys[snum])
 
-                to_add = every_sentence[current].group()
+        #the sentence may have been scanned already for batch review
+        if snum in batch_scans:
+            scan = batch_scans.pop(snum)
+        else:
+            scan = scanner.scan(document, snum)
 
-                #only add if it has a relevant equation in it
-                if r'\label{' in to_add:
+        #let the user know when the sentence is shown with less context than usual
+        #(sentences scanned ahead for batch review are reported when we get to them)
+        overrun = scanner.overruns.pop(snum, None)
 
-                    if main_name not in to_add:
-                        to_add = ""
+        if overrun is not None:
+            _report_overrun(options, overrun, scan is not None)
 
-                after = ''.join([after, to_add])
+        #don't do anything else if there aren't any indicators in the sentence
+        if scan is None:
+            continue
 
-                current += 1
+        context = scan.context
+        sentence_loc = scan.sentence_loc
+        assoc_equations = scan.equations
+        annotation_lines = scan.lines
+        ind_loc = scan.ind_loc
 
-            before = ""
-            start_loc = sentence.find(r'\begin{equation}\label{' + start_id + '}')
+        #review the next batch of lines once we're past the last one
+        if batch_size > 0 and snum > batch_end:
 
-            #first equation is in this sentence
-            if start_loc != -1:
-                sentence = sentence[start_loc:]
-            else:
-                start_loc = after.find(r'\begin{equation}\label{' + start_id + '}')
+            batch_scans[snum] = scan
 
-        #found an equation range, cut out after after last end equaiton
-        if found_range:
-            after = after[:after.rfind(r'\end{equation}') + len(r'\end{equation}')]
+            rows, batch_end = _next_candidates(scanner, document, snum, batch_size, cluster_answers, batch_scans)
 
-        #if variable is defined by an equation, replace eqref with text
-        for match in definition_pat.finditer(sentence):
+            del batch_scans[snum]
+            decisions = review_batch(rows)
 
-            eq_id = match.group("eq_id")
-            eq_pat = re.compile(r'\\begin{equation}\\label{' + eq_id + r'}.*?\n(?P<content>.*?)\n?\\end{equation}', re.DOTALL)
+            #user wants to quit
+            if decisions is None:
+                to_write = "{0}{1}".format(_create_comment_string(responses), snum)
+                _quick_exit(to_write, content, options)
 
-            search_text = before
-            eq_match = eq_pat.search(search_text)
+            batch_answers = decisions
 
-            current = snum - 2
+        rejected = 0
+        target = None
 
-            #keep looking backward until we have a match
-            while not eq_match and current > 0:
+        line_keys = [cluster_key(line) for line, line_loc in annotation_lines]
 
-                search_text = ''.join([every_sentence[current].group(), search_text])
-                eq_match = eq_pat.search(search_text) 
-                current -= 1
-                
-            #make sure we found something
-            if eq_match:
-                sentence = sentence.replace(r'\eqref{' + eq_id + '}', eq_match.group("content").strip().rstrip("."))
+        #ask user about each possible annotation
+        for line_num, (line, line_loc) in enumerate(annotation_lines):
 
-        context = before + "\n" + sentence + "\n" + after
+            to_write = "{0}{1}".format(_create_comment_string(responses), snum)
 
-        #find the equation ids of all the equations that may be associated with this annotation
-        for label_match in label_pat.finditer(context):
-            assoc_equations.append(label_match.group("eq_id"))
+            key = line_keys[line_num]
 
-        #take out the eq labels from the range if they exist
-        if found_range:
-            assoc_equations = assoc_equations[2:]
+            #lines like this one in the rest of this sentence and in the sentences after it
+            more = cluster_sizes[key] + line_keys[line_num + 1:].count(key)
 
-        seen = set()
-        indicator_found = False
+            result = None
+            accepted = batch_answers.pop((snum, line), None)
 
-        #go through each indicator
-        for indicator in indicators:
+            #rejected in batch review (even if the rest of its cluster was answered)
+            if accepted is False:
+                result = [()]
+                rejected += 1
 
-            #only reset the tracker if we haven't found an indicator yet
-            if not indicator_found:
-                ind_loc = 0
+            #the user already answered for every line like this one
+            elif key in cluster_answers:
+                result = _check_and_quit(apply_cluster_answer(cluster_answers[key], line, assoc_equations), to_write, content, options)
 
-            #go through each line in the sentence so we can print out the one with the indicator 
-            for line in sentence.split("\n"):
+            #no answer to reuse (or the user wants to override it)
+            if result is None:
 
-                #store each line that may contain an annotation
-                if (line not in seen
-                    and (" " + indicator + " " in line)
-                    or (indicator + " " in line and line.startswith(indicator))
-                    or (" " + indicator + ". " in line)):
+                #ask again if the user decides not to go anywhere
+                while result is None:
 
-                    annotation_lines.append("{0}: {1}".format(indicator, line.lstrip()))
-                    indicator_found = True
-                    seen.add(line)
+                    result = _check_and_quit(make_annotation_query(line, context, assoc_equations, sentence_loc + line_loc, labels, accepted, suggestions), to_write, content, options)
 
-                #increment tracker until we find first indicator
-                if not indicator_found:
-                    ind_loc += len(line) + 1
+                    #user wants to go somewhere else
+                    if result == ["GOTO"]:
+                        target = _get_target(document, source, snum, labels)
+                        result = None if target is None else []
 
-        #don't do anything else if there aren't any indicators in the sentence
-        if not indicator_found:
-            continue
+                #offer to use the answer for the rest of the cluster
+                if target is None and more > 0 and key not in cluster_answers:
 
-        #ask user about each possible annotation
-        for line in annotation_lines:
+                    share = get_input("There are {0} more line(s) like this one. Give them the same answer? (y/n)".format(more), set("yn"), wait=False)
 
-            to_write = "{0}{1}".format(_create_comment_string(responses), snum)
-            result = _check_and_quit(make_annotation_query(line, context, assoc_equations), to_write, content, options)
+                    #user wants to quit
+                    if share == "q":
+                        _quick_exit(to_write, content, options)
+
+                    if share == "y":
+                        cluster_answers[key] = result
+
+            #leave the rest of the sentence
+            if target is not None:
+                break
 
             #map each InputResponse to the sentence number
             for response in result:
                 responses[response] = snum
 
+            stats.record(line_indicator(line), line_position(line), any(result))
 
-        begin_loc = sentence_match.start() + rem_offset + ind_loc
-        end_loc = sentence_match.end() + rem_offset
+        #go where the user asked
+        if target is not None:
 
-        before = (begin_loc, end_loc)
+            _record_skip(navigation, snum, target)
 
-        #if there is an end equation at the beginning of the sentence, move past it
-        if content[begin_loc:].strip().startswith(r'\end{equation}'):
-            begin_loc = content.find(r'\end{equation}', begin_loc, end_loc) + len(r'\end{equation}')
+            next_snum = target
+            batch_end = target - 1
+            batch_answers = {}
+            batch_scans = {}
 
-        #if an equation is in the sentence, only remove until there
-        if r'\begin{equation}' in content[begin_loc:end_loc]:
-            end_loc = content.find(r'\begin{equation}', begin_loc, end_loc)
+            #lines like each line are counted again from where we're going
+            cluster_sizes = _count_clusters(sentence_keys, target)
 
-        #fragment has an index in it, stop before then
-        if r'\index' in content[begin_loc:end_loc]:
-            end_loc = content.find(r'\index', begin_loc, end_loc) - 1
+            continue
 
-        newline_loc = content.find('\n', begin_loc, end_loc)
+        #nothing to delete or keep when every line was rejected in batch review
+        if rejected == len(annotation_lines):
+            continue
 
-        #first line of the fragment is very short
-        if 0 < newline_loc - begin_loc < 5:
-        
-            #and ending character is }, probably shouldn't be included
-            if content[newline_loc - 1] == "}":
-                begin_loc = newline_loc + 1
+        #don't put markers around the sentence again if we've been here before
+        if snum in marked:
+            print("This sentence is already marked for deletion")
+            continue
+
+        #part of the sentence to delete (in the content we started with)
+        begin, end = fragment_span(source, document.boundaries, sentence_match.start() + ind_loc, sentence_match.end())
 
-        should_delete = get_input("Would you like to delete this sentence (fragment):\nSTART\n{0}\nEND\n(y/n)".format(content[begin_loc:end_loc]), valid=set("ynq"), wait=False)
+        #markers put in before the fragment move it along
+        begin_loc = begin + _marker_offset(insertions, begin)
+        end_loc = end + _marker_offset(insertions, end)
+
+        should_delete = get_input("Would you like to delete this sentence (fragment):\nSTART\n{0}\nEND\n(y/n)".format(_preview(content, begin_loc, end_loc, scanner.fallback_bytes)), valid=set("ynq"), wait=False)
 
         #user wants to quit
         if should_delete == "q":
@@ -349,10 +416,13 @@ def find_annotations(content, **options):
         #we need to delete the sentence (at least up to the first equation)
         if should_delete:
 
-            content = content[:begin_loc] + "~~~~REM_START~~~~" + content[begin_loc:end_loc] + "~~~~REM_END~~~~" + content[end_loc:]
+            content = content[:begin_loc] + REM_START + content[begin_loc:end_loc] + REM_END + content[end_loc:]
+
+            insort(insertions, (begin, len(REM_START)))
+            insort(insertions, (end, len(REM_END)))
 
-            rem_offset += len("~~~~REM_START~~~~")
-            rem_offset += len("~~~~REM_END~~~~")
+            marked.add(snum)
+            navigation["marked"].append(snum)
 
         #shouldn't delete sentence, ask about keywords
         else:
@@ -371,8 +441,7 @@ def find_annotations(content, **options):
 
                 new_keyword = get_input("Enter the new keyword:")
 
-                indicators.append(new_keyword)
-                indicators.append(new_keyword.title())
+                scanner.add_indicator(new_keyword)
 
             store_current = get_input("Would you like to store an annotation on this line? (y/n)", valid=set("yn"), wait=False)
 
@@ -387,30 +456,43 @@ def find_annotations(content, **options):
             if store_current:
 
                 to_write = "{0}{1}".format(_create_comment_string(responses), snum)
-                result = _check_and_quit(make_annotation_query("", context, assoc_equations), to_write, content, options)
+                result = _check_and_quit(make_annotation_query("", context, assoc_equations, sentence_loc, labels, suggestions=suggestions), to_write, content, options)
+
+                #user wants to go somewhere else instead
+                if result == ["GOTO"]:
+
+                    target = _get_target(document, source, snum, labels)
+                    result = []
+
+                    if target is not None:
+                        _record_skip(navigation, snum, target)
+                        next_snum = target
+                        batch_end = target - 1
+                        batch_answers = {}
 
                 #map each InputResponse to its sentence number
                 for response in result:
                     responses[response] = snum
 
     comment_str = _create_comment_string(responses)
+
+    #add the responses to the database if there is one
+    if options.get("store"):
+        store_responses(options["store"], options.get("input", ""), responses, every_sentence)
+
     content = comment_str + content
 
-    comment_insertion_pat = re.compile(r'^(?:\d+:)?{(?P<eq_id>.*?)}% *\\(?P<name>.*?){(?P<annotation>.*?)}(?P<between>.*?)(?P<equation>\\begin{equation}\\label{(?P=eq_id)}.*?\\end{equation})', re.DOTALL)
+    comment_insertion_pat = re.compile(r'^(?:\d+:)?{(?P<eq_id>.*?)}% *\\(?P<name>.*?){(?P<annotation>[^\n]*)}(?P<between>.*?)(?P<equation>\\begin{equation}\\label{(?P=eq_id)}.*?\\end{equation})', re.DOTALL)
 
     #as long as there is a match in content, keep replacing
     while comment_insertion_pat.match(content):
         content = comment_insertion_pat.sub(_insert_comment, content)
         content = content[1:]   #take out empty line
 
-    removal_fix_pat = re.compile(r'(\s*)~~~~REM_START~~~~(.*?)\n(\s*)\\end{equation}')
-    content = removal_fix_pat.sub(r'\1\2\n\3\\end{equation}', content)
-
-    removal_fix_pat = re.compile(r'\\index{(.*?)}\s*~~~~REM_END~~~~')
-    content = removal_fix_pat.sub(r'~~~~REM_END~~~~\\index{\1}', content)
+    content = remove_marked(content)
 
-    removal_pat = re.compile(r'~~~~REM_START~~~~.*?~~~~REM_END~~~~', re.DOTALL)
-    content = removal_pat.sub('', content)
+    #sentence numbers don't mean anything in the finished document
+    options["cursor"] = None
 
     save_state(comment_str, content, options)
 
@@ -433,6 +515,7 @@ def find_annotations(content, **options):
             fragment = []
 
         does_start_eq = line.strip().startswith(r'\begin{equation}')
+        is_index = line.strip().startswith(r'\index')
         is_sectioning = bool(sectioning_pat.search(line))
 
         #end of fragment if starting eq or index
@@ -475,17 +558,235 @@ def find_annotations(content, **options):
 
         current_loc += len(line)
 
+    expected = [(label, ANNOTATION_TYPES[response.type], response.annotation)
+                for response in responses for label in response.equations]
+
+    problems = validate(content.split("\n"), expected)
+
+    #make sure every annotation ended up where it should
+    if problems:
+        print("Found {0} problem(s) with the annotations:\n{1}".format(len(problems), format_problems(problems)))
+
     #delete the save file when we're done
+    save_file = _state_file(options, SAVE_FILE)
+
     try:
-        os.remove(SAVE_FILE)
+        os.remove(save_file)
     except OSError:
         print(("THE SAVE FILE COULD NOT BE REMOVED. PLEASE REMOVE IT "
-               "MANUALLY WITH rm .save"))
+               "MANUALLY WITH rm {0}".format(save_file)))
+
+    _remove_snapshot(options)
+
+    #let the user know what they didn't see
+    if navigation["skipped"]:
+        print("Skipped sentences: {0}".format(", ".join("{0}-{1}".format(first, last) for first, last in navigation["skipped"])))
 
     print("DONE")
 
     return content
 
+def fragment_span(source, boundaries, begin, end):
+    """
+    Returns the start and end of the part of `source` from `begin` to `end` to offer for deletion.
+
+    The part starts after an \\end{equation} at `begin`, and after a
+    very short first line ending with }. It stops at the first
+    \\begin{equation}, or just before the first \\index. Every
+    boundary is looked up in `boundaries` (a `PositionIndex` of
+    BOUNDARY_TOKENS in `source`), so no part of `source` is copied.
+    """
+
+    end_eq = r'\end{equation}'
+
+    #if there is an end equation at the beginning of the sentence, move past it
+    if source.startswith(end_eq, _whitespace_pat.match(source, begin).end()):
+        begin = boundaries.find(end_eq, begin, end) + len(end_eq)
+
+    eq_loc = boundaries.find(r'\begin{equation}', begin, end)
+
+    #if an equation is in the sentence, only remove until there
+    if eq_loc != -1:
+        end = eq_loc
+
+    index_loc = boundaries.find(r'\index', begin, end)
+
+    #fragment has an index in it, stop before then
+    if index_loc != -1:
+        end = index_loc - 1
+
+    newline_loc = boundaries.find("\n", begin, end)
+
+    #first line of the fragment is very short
+    if 0 < newline_loc - begin < 5:
+
+        #and ending character is }, probably shouldn't be included
+        if source[newline_loc - 1] == "}":
+            begin = newline_loc + 1
+
+    return begin, end
+
+def remove_marked(content):
+    """
+    Removes the text between REM_START and REM_END markers in one pass over content.
+
+    Two kinds of marked text are handled specially:
+
+    * if the rest of the line after a REM_START marker is the last
+      line of an equation, only the marker itself is removed
+    * an \\index{...} (and the whitespace after it) right before a
+      REM_END marker is moved after the marker, so it is kept
+
+    Markers that aren't closed are left in place. The result is the
+    same as applying those two fixes and then the removal one after
+    another, but only one new copy of content is made.
+    """
+
+    dropped = _dropped_markers(content)
+
+    kept = []
+
+    #text after an open REM_START (kept if it's never closed)
+    marked = None
+
+    copy_from = 0
+    pos = 0
+
+    #end of an \index{...} being moved after a REM_END, and of that REM_END
+    index_end = -1
+    rem_end = 0
+
+    match = _marker_pat.search(content)
+
+    #handle each marker or \index{ in order
+    while match:
+
+        #done with the moved index, skip the whitespace and REM_END after it
+        if index_end != -1 and match.start() >= index_end:
+
+            (kept if marked is None else marked).append(content[copy_from:index_end])
+
+            copy_from = rem_end
+            index_end = -1
+
+            match = _marker_pat.search(content, rem_end)
+            continue
+
+        pos = match.end()
+        target = kept if marked is None else marked
+
+        #index right before a REM_END goes after it (indexes inside one are just text)
+        if match.group() == r'\index{' and index_end == -1:
+
+            index_end, rem_end = _index_before_rem(content, match.start(), dropped)
+
+            if index_end != -1:
+
+                target.append(content[copy_from:match.start()])
+
+                #REM_END closes the marked text
+                if marked is not None:
+                    marked = None
+                else:
+                    kept.append(REM_END)
+
+                copy_from = match.start()
+
+        elif match.group() == REM_START:
+
+            #marker at the end of an equation is dropped on its own
+            if match.start() in dropped:
+
+                target.append(content[copy_from:match.start()])
+                copy_from = pos
+
+            #start removing text
+            elif marked is None:
+
+                kept.append(content[copy_from:match.start()])
+
+                marked = []
+                copy_from = match.start()
+
+        #stop removing text
+        elif match.group() == REM_END and marked is not None:
+
+            marked = None
+            copy_from = pos
+
+        match = _marker_pat.search(content, pos)
+
+    target = kept if marked is None else marked
+
+    #content ended inside a moved index
+    if index_end != -1:
+        target.append(content[copy_from:index_end])
+        copy_from = rem_end
+
+    target.append(content[copy_from:])
+
+    #never closed, so none of it is removed
+    if marked is not None:
+        kept.extend(marked)
+
+    return "".join(kept)
+
+#matches the markers and indexes that remove_marked has to handle
+_marker_pat = re.compile(re.escape(REM_START) + "|" + re.escape(REM_END) + r'|\\index{')
+
+_whitespace_pat = re.compile(r'\s*')
+
+#returns the set of locations of REM_START markers that are followed by the last line of an equation
+def _dropped_markers(content):
+
+    dropped = set()
+
+    fix_end = 0
+    rem_loc = content.find(REM_START)
+
+    #markers up to the end of a dropped marker's equation are never dropped
+    while rem_loc != -1:
+
+        newline_loc = content.find("\n", rem_loc + len(REM_START))
+
+        if rem_loc >= fix_end and newline_loc != -1:
+
+            eq_end_loc = _whitespace_pat.match(content, newline_loc + 1).end()
+
+            if content.startswith(r'\end{equation}', eq_end_loc):
+                dropped.add(rem_loc)
+                fix_end = eq_end_loc + len(r'\end{equation}')
+
+        rem_loc = content.find(REM_START, rem_loc + len(REM_START))
+
+    return dropped
+
+#returns the end of the \index{...} starting at pos and of the REM_END right after it (or -1s)
+def _index_before_rem(content, pos, dropped):
+
+    line_end = content.find("\n", pos)
+
+    if line_end == -1:
+        line_end = len(content)
+
+    brace_loc = content.find("}", pos + len(r'\index{'), line_end)
+
+    #try each closing brace on the line
+    while brace_loc != -1:
+
+        rem_loc = _whitespace_pat.match(content, brace_loc + 1).end()
+
+        #dropped markers don't count
+        while rem_loc in dropped:
+            rem_loc = _whitespace_pat.match(content, rem_loc + len(REM_START)).end()
+
+        if content.startswith(REM_END, rem_loc):
+            return brace_loc + 1, rem_loc + len(REM_END)
+
+        brace_loc = content.find("}", brace_loc + 1, line_end)
+
+    return -1, -1
+
 def remove_one(remove_lines, content, start):
     """
     Removes one occurence of to_remove from content starting at start.
@@ -518,14 +819,251 @@ def _quick_exit(progress, save, options):
 def save_state(progress, save, options):
     """
     Save program state into files specified by PROGRESS_FILE and SAVE_FILE.
+
+    The files are put in the session directory if there is one in
+    options, and in the working directory otherwise.
+    """
+
+    writeout(_state_file(options, PROGRESS_FILE), progress, options["append"])
+    writeout_atomic(_state_file(options, SAVE_FILE), iter_chunks(save))
+
+    #remember where the user skipped and what they deleted
+    if options.get("navigation") is not None:
+        writeout_atomic(_state_file(options, NAVIGATION_FILE), [json.dumps(options["navigation"])])
+
+    #add this session's answers to the indicator precision
+    if options.get("stats") is not None:
+        options["stats"].save()
+
+    #save the parsed save file so resuming doesn't have to parse it again
+    if options.get("cursor") is not None:
+        save_document(_state_file(options, SNAPSHOT_FILE), save, index_document(save), options["cursor"])
+    else:
+        _remove_snapshot(options)
+
+def save_document(filename, content, document, cursor):
+    """
+    Saves `DocumentIndex` document of content, and the current sentence, to snapshot filename.
+    """
+
+    arrays = {
+        "starts": document.sentences.starts,
+        "ends": document.sentences.ends,
+        "sections": document.sections,
+        "eq_starts": array("l", (span[0] for span in document.equations.values())),
+        "eq_ends": array("l", (span[1] for span in document.equations.values()))
+    }
+
+    for i, offsets in enumerate(document.boundaries.offsets):
+        arrays["boundaries{0}".format(i)] = offsets
+
+    save_snapshot(filename, content, arrays, cursor=cursor, labels=list(document.equations))
+
+def load_document(filename, content, cursor):
+    """
+    Returns the `DocumentIndex` of content saved in snapshot filename.
+
+    None is returned if there is no usable snapshot, if it was saved
+    for different content, or if it was saved at a sentence other
+    than `cursor`.
+    """
+
+    snapshot = load_snapshot(filename, content)
+
+    if snapshot is None:
+        return None
+
+    arrays, fields = snapshot
+
+    if fields.get("cursor") != cursor:
+        return None
+
+    boundaries = [arrays.get("boundaries{0}".format(i)) for i in xrange(len(BOUNDARY_TOKENS))]
+
+    #snapshots from before boundaries were kept can't be used
+    if None in boundaries:
+        return None
+
+    sentences = SentenceTable.from_offsets(content, arrays["starts"], arrays["ends"])
+    equations = OrderedDict(zip(fields["labels"], zip(arrays["eq_starts"], arrays["eq_ends"])))
+
+    return DocumentIndex(sentences, equations, arrays["sections"], PositionIndex.from_offsets(BOUNDARY_TOKENS, boundaries))
+
+def load_navigation(filename):
+    """
+    Returns the skipped ranges and marked sentences saved in filename.
+
+    Empty lists are returned if there is no usable file.
+    """
+
+    try:
+        with open(filename) as in_file:
+            navigation = json.load(in_file)
+    except (IOError, ValueError):
+        navigation = {}
+
+    navigation.setdefault("skipped", [])
+    navigation.setdefault("marked", [])
+
+    return navigation
+
+def find_target(command, document, source, snum):
+    """
+    Returns the number of the sentence that navigation `command` goes to from sentence `snum`.
+
+    `command` is one of:
+
+    * a sentence number
+    * an equation label (the sentence that the equation is in)
+    * "n" or "p" for the next or previous section
+    * "s" to skip the rest of the current section (go to the next
+      section that isn't inside it, or to the end of the document,
+      given as the number of sentences, if it is the last one)
+
+    Sections are found with a binary search over the offsets in
+    `document` (a `DocumentIndex` of `source`). None is returned if
+    there is nowhere to go.
     """
 
-    writeout(PROGRESS_FILE, progress, options["append"])
-    writeout(SAVE_FILE, save)
+    sentences = document.sentences
+    sections = document.sections
+
+    if command.isdigit():
+
+        target = int(command)
+
+        if target < len(sentences):
+            return target
+
+        return None
+
+    if command in document.equations:
+        return _sentence_at(sentences, document.equations[command][0])
+
+    #sections that start after the current sentence
+    section_num = bisect_right(sections, sentences.starts[snum])
+
+    #go to the start of the section before the one we're in
+    if command == "p":
+
+        if section_num > 1:
+            return _sentence_at(sentences, sections[section_num - 2])
+
+        return None
+
+    if command == "n":
+        level = len(SECTION_LEVELS)
+    elif command == "s" and section_num > 0:
+        level = section_level(source, sections[section_num - 1])
+    else:
+        return None
+
+    #find the next section at or above level
+    for i in xrange(section_num, len(sections)):
+
+        if section_level(source, sections[i]) > level:
+            continue
+
+        target = _sentence_at(sentences, sections[i])
+
+        if target is not None and target > snum:
+            return target
+
+    #the rest of the last section is the rest of the document
+    if command == "s":
+        return len(sentences)
+
+    return None
+
+#returns the number of the sentence containing (or after) offset pos, or None
+def _sentence_at(sentences, pos):
+
+    snum = bisect_right(sentences.starts, pos) - 1
+
+    if snum < 0 or sentences.ends[snum] <= pos:
+        snum += 1
+
+    if snum < len(sentences):
+        return snum
+
+    return None
+
+#asks the user where to go from sentence snum and returns the sentence number (None means stay)
+def _get_target(document, source, snum, labels):
+
+    prompt = "Go to a sentence number or equation label, (n)ext or (p)revious section, (s)kip the rest of this section or (c)ancel:"
+
+    command = get_input(prompt, preserve_case=True, completer=labels).strip()
+
+    if command.lower() == "c":
+        return None
+
+    target = find_target(command, document, source, snum)
+
+    if target is None:
+        print("There is nowhere to go for {0}".format(command))
+
+    return target
+
+#returns how many lines there are with each cluster key from sentence start on
+def _count_clusters(sentence_keys, start):
+
+    cluster_sizes = Counter()
+
+    for keys in sentence_keys[start:]:
+        cluster_sizes.update(keys)
+
+    return cluster_sizes
+
+#records that the sentences between snum and target were skipped over
+def _record_skip(navigation, snum, target):
+
+    if target > snum + 1:
+        navigation["skipped"].append([snum + 1, target - 1])
+
+#returns the total length of the markers put in at or before original offset pos
+def _marker_offset(insertions, pos):
+    return sum(length for offset, length in insertions[:bisect_right(insertions, (pos, sys.maxsize))])
+
+#returns the path of state file name for the session in options
+def _state_file(options, name):
+
+    session = options.get("session")
+
+    if session is None:
+        return name
+
+    return session.path(name)
+
+#returns content[begin:end], cut to its first size bytes (and how much was left out) if it's longer
+def _preview(content, begin, end, size):
+
+    if end - begin <= size:
+        return content[begin:end]
+
+    return "{0}\n[... {1} MORE BYTES]".format(content[begin:begin + size], end - begin - size)
+
+#adds scanner overrun to the metrics report (and tells the user if the sentence is being shown)
+def _report_overrun(options, overrun, shown):
+
+    if shown:
+        print("SENTENCE #{0} TOOK TOO LONG TO SCAN ({1}) - SHOWING IT WITH ITS NEIGHBOURS ONLY".format(overrun.sentence, overrun.stage))
+
+    row = "sentence {0} (offsets {1}-{2}): {3} stopped after {4} bytes in {5:.3f}s\n".format(*overrun)
+
+    writeout(_state_file(options, METRICS_FILE), row, append=True)
+
+#deletes the snapshot file if there is one
+def _remove_snapshot(options):
+
+    try:
+        os.remove(_state_file(options, SNAPSHOT_FILE))
+    except OSError:
+        pass
 
 #checks if the user want to quit and takes appropriate action if they do
 def _is_quit(result):
-    return "QUIT" in result
+    return result is not None and "QUIT" in result
 
 #returns the "comment_str" to be written given the responses list
 def _create_comment_string(responses):
@@ -559,7 +1097,7 @@ def _insert_comment(match):
 
     return "{between}{equation}".format(between=match.group("between"), equation=equation) 
 
-def make_annotation_query(line, context, assoc_eqs):
+def make_annotation_query(line, context, assoc_eqs, marker_loc=-1, labels=None, accepted=False, suggestions=None):
     """
     Queries the user for information about the possible annotation.
 
@@ -567,35 +1105,66 @@ def make_annotation_query(line, context, assoc_eqs):
     and returns a list of InputResponse tuples containing the result
     of the query. If the annotation was incorrectly identified
     (i.e. it is not an annotation) a list containing an empty
-    tuple will be returned.
+    tuple will be returned. `marker_loc` is the offset in `context`
+    of the line to mark with ----->, and only the lines around it
+    are shown until the user asks for more. If `labels` (a LabelTrie)
+    is given and not empty, the labels of added equations are tab
+    completed from it and have to be in it. If `accepted` is True,
+    the line was already accepted (in batch review), so the user
+    isn't asked whether it is an annotation. If `suggestions` (a
+    SuggestionIndex) is given, texts for the annotation are suggested
+    from it and the math in the line, and new texts are added to it.
     """
 
-    to_join = context.split("\n")
+    #there is nothing to check labels against
+    if not labels:
+        labels = None
 
-    #place -----> marker in front of vital line
-    for num, l in enumerate(to_join):
-        if l.strip() and l == line[line.find(": ") + 2:]:
-            to_join[num] = "----->" + l
+    yes_no_responses = set(["y", "n", "yes", "no"])
 
-    context = "\n".join(to_join)
+    radius = CONTEXT_LINES
+    collapse = True
 
-    yes_no_responses = set(["y", "n", "yes", "no"])
+    valid_check = "m"
 
-    print("\n----------------------------------------\nIdentified the following:")
-    print(line) 
+    #go straight to entering the annotation
+    if accepted:
 
-    print("")
-    
-    print("In the context of:")
-    print(context)
-    print("----------------------------------------\n")
+        print("\n----------------------------------------\nAnnotating the following:")
+        print(line)
+
+        valid_check = "y"
+
+    #keep showing the context until the user stops asking for more
+    while valid_check in ("m", "e"):
+
+        print("\n----------------------------------------\nIdentified the following:")
+        print(line) 
 
-    valid_check = get_input("Is this an annotation? (y/n or q to quit):", yes_no_responses, wait=False)
+        print("")
+        
+        print("In the context of:")
+        print(render_context(context, marker_loc, radius, collapse))
+        print("----------------------------------------\n")
+
+        valid_check = get_input("Is this an annotation? (y/n, (m)ore context, show (e)quations, (g)o to or q to quit):", yes_no_responses | set(["m", "e", "g"]), wait=False)
+
+        #double the number of lines shown
+        if valid_check == "m":
+            radius *= 2
+
+        #switch between collapsed and full equations
+        if valid_check == "e":
+            collapse = not collapse
 
     #quit if the user types q
     if valid_check == "q":
         return ["QUIT"]
 
+    #user wants to go somewhere else in the document
+    if valid_check == "g":
+        return ["GOTO"]
+
     #not actually an annotation, return empty
     if valid_check == "n" or valid_check == "no":
         return [()]
@@ -619,7 +1188,11 @@ def make_annotation_query(line, context, assoc_eqs):
         if annotation_type == "q":
             return ["QUIT"]    
 
-        annotation = get_input("Enter the actual text of the annotation:")
+        annotation = _get_annotation(line, suggestions)
+
+        #quit if user presses q
+        if annotation is None:
+            return ["QUIT"]
 
         print("\nThe predicted associated equations are:") 
     
@@ -650,9 +1223,14 @@ def make_annotation_query(line, context, assoc_eqs):
             #display adding menu
             if add_remove == "a":
 
-                eq_label = get_input("Enter the label for the equation you would like to add:", preserve_case=True)
-                assoc_eqs.append(eq_label) 
-                print("Equation added")
+                eq_label = _get_label(labels)
+
+                #user changed their mind
+                if eq_label is None:
+                    print("No equation added")
+                else:
+                    assoc_eqs.append(eq_label)
+                    print("Equation added")
 
             #display removal menu
             if add_remove == "r":
@@ -707,6 +1285,201 @@ def make_annotation_query(line, context, assoc_eqs):
 
     return to_return
 
+def render_context(context, marker_loc=-1, radius=CONTEXT_LINES, collapse=True):
+    """
+    Returns the lines of `context` within `radius` lines of `marker_loc`.
+
+    The line containing offset `marker_loc` is prefixed with the
+    -----> marker (no line is marked if `marker_loc` is negative, and
+    the window starts at the beginning of `context`). If `collapse` is
+    True, equations that are entirely above or below the marked line
+    are shown as just their labels. Only the window itself is copied
+    out of `context`, so the cost does not depend on its length.
+    """
+
+    line_start = 0
+
+    #find the start of the marked line
+    if marker_loc >= 0:
+        line_start = context.rfind("\n", 0, marker_loc) + 1
+
+    window_start = line_start
+
+    #walk back radius lines
+    for i in xrange(radius):
+
+        if window_start == 0:
+            break
+
+        window_start = context.rfind("\n", 0, window_start - 1) + 1
+
+    window_end = line_start
+
+    #walk forward radius lines (and the marked line itself)
+    for i in xrange(radius + 1):
+
+        window_end = context.find("\n", window_end) + 1
+
+        if window_end == 0:
+            window_end = len(context)
+            break
+
+    above = context[window_start:line_start]
+    below = context[line_start:window_end]
+
+    #fold up every complete equation
+    if collapse:
+        above = _equation_pat.sub(_collapse_equation, above)
+        below = _equation_pat.sub(_collapse_equation, below)
+
+    #place -----> marker in front of vital line
+    if marker_loc >= 0:
+        below = "----->" + below
+
+    to_join = [above, below.rstrip("\n")]
+
+    hidden_above = context.count("\n", 0, window_start)
+    hidden_below = context.count("\n", window_end)
+
+    #let the user know that there is more to see
+    if hidden_above:
+        to_join.insert(0, "[{0} more line(s) above]\n".format(hidden_above))
+    if hidden_below:
+        to_join.append("\n[{0} more line(s) below]".format(hidden_below + 1))
+
+    return "".join(to_join)
+
+#matches a whole equation, remembering its label
+_equation_pat = re.compile(r'\\begin{equation}(?P<label>\\label{.*?})?.*?\\end{equation}', re.DOTALL)
+
+#replaces an equation with a single line containing its label
+def _collapse_equation(match):
+    return r'\begin{{equation}}{0} ... \end{{equation}}'.format(match.group("label") or "")
+
+def review_batch(rows):
+    """
+    Asks the user to accept or reject every line in `rows` from one compact list.
+
+    `rows` is a list of `Candidate` tuples from `_next_candidates`
+    (as the lines will be asked about in the main loop). The user can answer every row at
+    once (e.g. ynnyn), answer one row (e.g. 3y) or see the context of
+    a row by giving its number. Returns a dictionary mapping the
+    sentence number and line of each row to True if it was accepted
+    and False if it wasn't, or None if the user wants to quit.
+    """
+
+    marks = [" "] * len(rows)
+
+    #keep asking until every row has an answer
+    while " " in marks:
+
+        print("\n----------------------------------------\nPossible annotations:")
+
+        for i, row in enumerate(rows):
+            print("{0:>3} [{1}] #{2}: {3}".format(i + 1, marks[i], row.sentence, remove_inner_whitespace(row.line)[:70]))
+
+        print("----------------------------------------\n")
+
+        answer = get_input("Answer each row (e.g. {0}), a row number to see it, a row number and y/n to answer it, or q to quit:".format("yn" * (len(rows) // 2) + "y" * (len(rows) % 2))).strip()
+
+        #quit if the user types q
+        if answer == "q":
+            return None
+
+        match = re.match(r'^(\d+)([yn]?)$', answer)
+
+        #one answer for every row
+        if len(answer) == len(rows) and all(char in "yn" for char in answer):
+            marks = list(answer)
+
+        #show or answer one row
+        elif match and 0 < int(match.group(1)) <= len(rows):
+
+            row = int(match.group(1)) - 1
+
+            if match.group(2):
+                marks[row] = match.group(2)
+            else:
+                print("\n{0}\n\nIn the context of:\n{1}".format(rows[row].line, render_context(rows[row].context, rows[row].marker_loc)))
+
+        else:
+            print("That is not a valid response. Please try again.")
+
+    return dict(((row.sentence, row.line), mark == "y") for row, mark in zip(rows, marks))
+
+#returns a Candidate for each line that will be asked about from sentence snum on (skipping clusters in skip_keys), in whole sentences while there are no more than size of them, and the last sentence looked at
+#(sentences are only scanned if they aren't in scans, and the scans made are added to it so they aren't made again)
+def _next_candidates(scanner, document, snum, size, skip_keys, scans):
+
+    rows = []
+
+    while snum < len(document.sentences):
+
+        if snum not in scans:
+            scans[snum] = scanner.scan(document, snum)
+
+        scan = scans[snum]
+        lines = []
+
+        if scan is not None:
+            lines = [Candidate(snum, line, scan.context, scan.sentence_loc + line_loc, scan.equations)
+                     for line, line_loc in scan.lines if cluster_key(line) not in skip_keys]
+
+        #don't split sentences between batches
+        if rows and len(rows) + len(lines) > size:
+            break
+
+        rows.extend(lines)
+        snum += 1
+
+    return rows, snum - 1
+
+def apply_cluster_answer(answer, line, assoc_eqs):
+    """
+    Asks the user whether to reuse `answer` (from `make_annotation_query`) for `line`.
+
+    Returns the list of InputResponse tuples for `line`, with the
+    equations replaced by the ones predicted for it (`assoc_eqs`)
+    when there are any. None is returned if the user would rather
+    answer for `line` separately, and ["QUIT"] if they want to quit.
+    """
+
+    print("\n----------------------------------------\nIdentified the following:")
+    print(line)
+    print("\nA line like this one was answered with:")
+
+    #describe the earlier answer
+    for response in answer:
+
+        if response:
+            print("\t{0}{{{1}}} for {2}".format(ANNOTATION_TYPES[response.type], response.annotation, ", ".join(sorted(response.equations))))
+        else:
+            print("\tnot an annotation")
+
+    print("----------------------------------------\n")
+
+    should_apply = get_input("Give this line the same answer? (y)es/(o)verride:", set(["y", "o"]), wait=False)
+
+    #quit if the user types q
+    if should_apply == "q":
+        return ["QUIT"]
+
+    #user wants to answer this one themselves
+    if should_apply == "o":
+        return None
+
+    to_return = []
+
+    #use this line's equations if it has any
+    for response in answer:
+
+        if response and assoc_eqs:
+            response = response._replace(equations=frozenset(assoc_eqs))
+
+        to_return.append(response)
+
+    return to_return
+
 def input_to_comment(response, snum):
     """
     Takes `InputResponse` and sequence number and returns appropriate comment.
@@ -746,22 +1519,59 @@ def input_to_comment(response, snum):
 
     """
 
-    type_dict = {
-        "c": "constraint",
-        "s": "substitution",
-        "m": "drmfname",
-        "n": "drmfnote",
-        "p": "proof"
-    }
-
     comment_str = "{0}:".format(snum)
 
     #create a new comment line for each equation
     for equation in response.equations: 
-        comment_str += "{{{equation}}}% \\{type}{{{annotation}}}\n".format(type=type_dict[response.type], annotation=response.annotation, equation=equation)
+        comment_str += "{{{equation}}}% \\{type}{{{annotation}}}\n".format(type=ANNOTATION_TYPES[response.type], annotation=response.annotation, equation=equation)
 
     return comment_str
 
+#matches a deletion marker
+_rem_pat = re.compile(re.escape(REM_START) + "|" + re.escape(REM_END))
+
+def store_responses(filename, fname, responses, sentences):
+    """
+    Adds each `InputResponse` in `responses` to the annotation database `filename`.
+
+    `responses` maps each response to its sentence number, and the
+    offsets stored with it are those of the sentence in the input
+    file. When resuming, `sentences` are in the save file, so the
+    markers from earlier sessions are left out of the offsets.
+    There is one record for every equation the response applies to.
+    """
+
+    records = []
+
+    #offset of each marker in the save file, and the total length of the markers before it
+    marker_starts = []
+    marker_totals = [0]
+
+    for match in _rem_pat.finditer(sentences.source):
+        marker_starts.append(match.start())
+        marker_totals.append(marker_totals[-1] + len(match.group()))
+
+    #offset in the input of offset pos in the save file
+    def input_offset(pos):
+        return pos - marker_totals[bisect_left(marker_starts, pos)]
+
+    #one record for each equation of each response
+    for response, snum in responses.items():
+
+        #skip the responses that weren't annotations
+        if not response:
+            continue
+
+        sentence = sentences[snum]
+
+        for equation in sorted(response.equations):
+            records.append(AnnotationRecord(fname, equation, ANNOTATION_TYPES[response.type], response.annotation,
+                                            snum, input_offset(sentence.start()), input_offset(sentence.end()), SENTENCE_OFFSETS))
+
+    store = AnnotationStore(filename)
+    store.upsert(records)
+    store.close()
+
 def get_options():
     """
     Returns a dictionary of options necessary for the program.
@@ -779,6 +1589,88 @@ def get_options():
 
     return options
 
+#asks for an equation label until one that is in labels is given (None means the user cancelled)
+def _get_label(labels):
+
+    prompt = "Enter the label for the equation you would like to add ((q) cancels):"
+
+    #let the user know they can complete labels
+    if labels is not None and readline is not None:
+        prompt = "Enter the label for the equation you would like to add (tab completes, (q) cancels):"
+
+    eq_label = get_input(prompt, preserve_case=True, completer=labels).strip()
+
+    #keep asking until we get a label that exists (or the user gives up)
+    while labels is not None and eq_label not in labels:
+
+        if eq_label.lower() == "q":
+            break
+
+        matches = labels.keys(eq_label)
+
+        #show the labels the user may have meant
+        if matches:
+
+            print("Labels starting with {0}:".format(eq_label))
+
+            for match in matches[:MAX_LISTED_LABELS]:
+                print("\t{0}".format(match))
+
+            if len(matches) > MAX_LISTED_LABELS:
+                print("\t({0} more)".format(len(matches) - MAX_LISTED_LABELS))
+
+        else:
+            print("There is no equation labelled {0}".format(eq_label))
+
+        eq_label = get_input(prompt, preserve_case=True, completer=labels).strip()
+
+    #user cancelled
+    if eq_label.lower() == "q":
+        return None
+
+    return eq_label
+
+#asks for the text of an annotation on line, letting the user pick one of the suggestions for it (None means quit)
+def _get_annotation(line, suggestions):
+
+    if suggestions is None:
+        return get_input("Enter the actual text of the annotation:", preserve_case=True)
+
+    ranked = suggestions.suggest(line, math_spans(line))
+
+    choice = "t"
+
+    #one key picks a suggestion
+    if ranked:
+
+        print("\nSuggested annotations:")
+
+        for i, text in enumerate(ranked):
+            print("\t{0}: {1}".format(i + 1, text))
+
+        choice = get_input("Pick a suggestion (1-{0}) or (t)ype the annotation:".format(len(ranked)), set(map(str, xrange(1, len(ranked) + 1))) | set(["t"]), wait=False)
+
+    #quit if user presses q
+    if choice == "q":
+        return None
+
+    if choice == "t":
+
+        prompt = "Enter the actual text of the annotation:"
+
+        #let the user know they can complete words
+        if len(suggestions) and readline is not None:
+            prompt = "Enter the actual text of the annotation (tab completes):"
+
+        annotation = get_input(prompt, preserve_case=True, completer=suggestions.words)
+
+    else:
+        annotation = ranked[int(choice) - 1]
+
+    suggestions.remember(annotation)
+
+    return annotation
+
 #parses a comma separated list (string) into a python list
 def _parse_list(list_str):
 
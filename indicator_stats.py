@@ -0,0 +1,209 @@
+"""
+Keeps track of how often the lines found by each indicator are annotations.
+
+Counts are kept separately for lines that start with the indicator
+and lines that only contain it, and are saved to a JSON file shared
+by every session, so the indicators that mostly find lines that
+aren't annotations can be tried last or not at all. The module can
+also be run directly:
+
+    python indicator_stats.py statsfile
+
+Which prints the precision of every indicator in the file.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+
+from utilities import writeout_atomic
+from session import file_lock
+
+#indicators with fewer answers than this are never disabled
+MIN_SAMPLES = 20
+
+#where the indicator was in the line it found
+POSITIONS = ("start", "inside")
+
+#added to the name of the stats file to get the name of its lock file
+LOCK_SUFFIX = ".lock"
+
+def main():
+
+    if len(sys.argv) != 2:
+
+        print("Usage: {0} <statsfile>".format(sys.argv[0]))
+        sys.exit(-1)
+
+    stats = IndicatorStats(sys.argv[1])
+
+    print(stats.summary(sorted(stats.counts)))
+
+class IndicatorStats(object):
+    """
+    Accepted and rejected counts for every indicator.
+
+    For example:::
+
+        stats = IndicatorStats(".annotations/indicators.json")
+        stats.record("In", "inside", False)
+
+        stats.precision("In")    #returns the fraction of lines found by "In" that were annotations
+        stats.save()
+
+    """
+
+    def __init__(self, filename=None):
+
+        self.filename = filename
+
+        #indicator to position to [accepted, rejected]
+        self.counts = {}
+
+        #counts recorded since the last save
+        self._new = {}
+
+        if filename is not None:
+            self.counts = _read_counts(filename)
+
+    def record(self, indicator, position, accepted):
+        """
+        Counts a line found by `indicator` at `position` as accepted or rejected.
+        """
+
+        column = 0 if accepted else 1
+
+        for counts in (self.counts, self._new):
+            counts.setdefault(indicator, {}).setdefault(position, [0, 0])[column] += 1
+
+    def samples(self, indicator):
+        """
+        Returns the number of lines found by `indicator` that were answered.
+        """
+
+        return sum(sum(pair) for pair in self.counts.get(indicator, {}).values())
+
+    def precision(self, indicator, position=None):
+        """
+        Returns the fraction of lines found by `indicator` that were accepted.
+
+        Only lines at `position` are counted if it is given. None is
+        returned if no lines have been answered.
+        """
+
+        pairs = self.counts.get(indicator, {})
+
+        if position is not None:
+            pairs = {position: pairs.get(position, [0, 0])}
+
+        accepted = sum(pair[0] for pair in pairs.values())
+        total = sum(sum(pair) for pair in pairs.values())
+
+        if total == 0:
+            return None
+
+        return float(accepted) / total
+
+    def order(self, indicators, min_precision=0.0):
+        """
+        Returns `indicators` from the most to the least precise, without the disabled ones.
+
+        An indicator is disabled if its precision is below
+        `min_precision` after at least MIN_SAMPLES answers. Indicators
+        with few answers are ranked as if half were accepted, and
+        ties keep their order in `indicators`.
+        """
+
+        #precision, pulled towards one half when there are few answers
+        def smoothed(indicator):
+
+            pairs = self.counts.get(indicator, {}).values()
+
+            return (sum(pair[0] for pair in pairs) + 1.0) / (self.samples(indicator) + 2.0)
+
+        enabled = [indicator for indicator in indicators if not self.disabled(indicator, min_precision)]
+
+        return sorted(enabled, key=lambda indicator: -smoothed(indicator))
+
+    def disabled(self, indicator, min_precision):
+        """
+        Returns True if `indicator` has enough answers and a precision below `min_precision`.
+        """
+
+        return self.samples(indicator) >= MIN_SAMPLES and self.precision(indicator) < min_precision
+
+    def summary(self, indicators, min_precision=0.0):
+        """
+        Returns a table of the precision of each indicator in `indicators`.
+        """
+
+        rows = []
+
+        for indicator in indicators:
+
+            precision = self.precision(indicator)
+
+            #nothing to show yet
+            if precision is None:
+                continue
+
+            positions = []
+
+            for position in POSITIONS:
+
+                position_precision = self.precision(indicator, position)
+
+                if position_precision is not None:
+                    positions.append("{0} {1:.0%}".format(position, position_precision))
+
+            row = "\t{0:<12}{1:>5.0%} of {2} ({3})".format(indicator, precision, self.samples(indicator), ", ".join(positions))
+
+            if self.disabled(indicator, min_precision):
+                row += " DISABLED"
+
+            rows.append(row)
+
+        return "\n".join(rows)
+
+    def save(self):
+        """
+        Adds the counts recorded since the last save to the stats file.
+
+        The file is read again first, so the counts saved by other
+        sessions in the meantime are kept, and it is locked while it is
+        being read and written, so sessions saving at the same time
+        don't lose each other's counts.
+        """
+
+        if self.filename is None or not self._new:
+            return
+
+        with file_lock(self.filename + LOCK_SUFFIX):
+
+            counts = _read_counts(self.filename)
+
+            for indicator, positions in self._new.items():
+                for position, pair in positions.items():
+
+                    saved = counts.setdefault(indicator, {}).setdefault(position, [0, 0])
+
+                    saved[0] += pair[0]
+                    saved[1] += pair[1]
+
+            writeout_atomic(self.filename, [json.dumps(counts, indent=1, sort_keys=True)])
+
+        self.counts = counts
+        self._new = {}
+
+#returns the counts in stats file filename (or none if it can't be read)
+def _read_counts(filename):
+
+    try:
+        with open(filename) as in_file:
+            return json.load(in_file)
+    except (IOError, ValueError):
+        return {}
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Builds and reads an on-disk index of the equation labels in a set of TeX files.
+
+The index holds the label, file, span and body of every labelled
+equation. It is stored in a compact binary form that is read through
+a read-only memory map, so any number of processes can share one
+index without parsing the TeX files again. The module can also be
+run directly:
+
+    python label_index.py build indexfile texfile [texfile ...]
+    python label_index.py lookup indexfile label
+
+Where `build` indexes the equations in the TeX files and `lookup`
+prints the equation with the given label.
+"""
+
+from __future__ import print_function
+
+import re
+import sys
+import mmap
+import struct
+from collections import namedtuple
+
+from utilities import readin, writeout_atomic
+
+#an equation in the index (start and end are character offsets in file)
+LabelEntry = namedtuple("LabelEntry", "label file start end body")
+
+#identifies a label index file
+MAGIC = b"LBLIDX01"
+
+#magic, number of equations, number of files
+_HEADER = struct.Struct("<8sII")
+
+#offset and length of a file name in the string block
+_FILE = struct.Struct("<II")
+
+#label offset and length, file number, start, end, body offset and length, position in document order
+_RECORD = struct.Struct("<IIIIIIII")
+
+#record number of each equation, in document order
+_ORDER = struct.Struct("<I")
+
+#matches an equation along with its label
+_equation_pat = re.compile(r'\\begin{equation}\\label{(?P<label>eq:[^}]*)}(?P<body>.*?)\\end{equation}', re.DOTALL)
+
+def main():
+
+    if len(sys.argv) < 4 or sys.argv[1] not in ("build", "lookup"):
+
+        print("Usage: {0} build <indexfile> <texfile> [<texfile> ...]".format(sys.argv[0]))
+        print("       {0} lookup <indexfile> <label>".format(sys.argv[0]))
+        sys.exit(-1)
+
+    #index every file given
+    if sys.argv[1] == "build":
+
+        count = build_index(sys.argv[2], sys.argv[3:])
+        print("Indexed {0} equations".format(count))
+
+    #print the equation
+    else:
+
+        index = LabelIndex(sys.argv[2])
+        entry = index.get(sys.argv[3])
+
+        if entry is None:
+            print("There is no equation labelled {0}".format(sys.argv[3]))
+        else:
+            print("{0} ({1}:{2}-{3})\n{4}".format(entry.label, entry.file, entry.start, entry.end, entry.body))
+
+        index.close()
+
+def iter_equations(content):
+    """
+    Yields the label, start, end and body of each labelled equation in content.
+    """
+
+    for match in _equation_pat.finditer(content):
+        yield match.group("label"), match.start(), match.end(), equation_body(match.group())
+
+def equation_body(equation):
+    """
+    Returns the body of `equation`, the text of a whole equation environment.
+
+    The body is everything after the line with the label, up to
+    (but not including) the line with \\end{equation}.
+    """
+
+    body = equation[:equation.rfind(r'\end{equation}')]
+    newline_loc = body.find("\n")
+
+    #skip the rest of the line the label is on
+    if newline_loc != -1:
+        body = body[newline_loc + 1:]
+
+    if body.endswith("\n"):
+        body = body[:-1]
+
+    return body
+
+def build_index(filename, tex_files):
+    """
+    Writes an index of the equations in every file in `tex_files` to `filename`.
+
+    Returns the number of equations indexed. If a label is used in
+    more than one file, every one is indexed but lookups will return
+    the one from the file that was given first.
+    """
+
+    strings = bytearray()
+
+    #adds text to the string block and returns its offset and length
+    def add_string(text):
+
+        encoded = text.encode("utf-8")
+        offset = len(strings)
+        strings.extend(encoded)
+
+        return offset, len(encoded)
+
+    files = [add_string(fname) for fname in tex_files]
+    entries = []
+
+    #collect every equation in document order
+    for file_num, fname in enumerate(tex_files):
+        for label, start, end, body in iter_equations(readin(fname)):
+            entries.append((label.encode("utf-8"), file_num, start, end, body))
+
+    #records are stored sorted by label, but remember where each was in the document
+    by_label = sorted(range(len(entries)), key=lambda i: (entries[i][0], i))
+    positions = [0] * len(entries)
+
+    for order, i in enumerate(by_label):
+        positions[i] = order
+
+    records = []
+
+    for i in by_label:
+
+        label, file_num, start, end, body = entries[i]
+
+        label_offset = len(strings)
+        strings.extend(label)
+
+        body_offset, body_length = add_string(body)
+
+        records.append(_RECORD.pack(label_offset, len(label), file_num, start, end, body_offset, body_length, i))
+
+    chunks = [_HEADER.pack(MAGIC, len(entries), len(files))]
+    chunks.extend(_FILE.pack(*f) for f in files)
+    chunks.extend(records)
+    chunks.extend(_ORDER.pack(positions[i]) for i in range(len(entries)))
+    chunks.append(bytes(strings))
+
+    writeout_atomic(filename, chunks, binary=True)
+
+    return len(entries)
+
+class LabelIndex(object):
+    """
+    Read-only view of an index written by `build_index`.
+
+    Labels are found with a binary search over the memory mapped
+    file, so opening an index and looking up a label don't depend on
+    how many equations or files were indexed.
+    """
+
+    def __init__(self, filename):
+
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, num_files = _HEADER.unpack_from(self._map, 0)
+
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("{0} is not a label index".format(filename))
+
+        self._files_start = _HEADER.size
+        self._records_start = self._files_start + num_files * _FILE.size
+        self._order_start = self._records_start + self.count * _RECORD.size
+        self._strings_start = self._order_start + self.count * _ORDER.size
+
+        self.files = [self._string(*_FILE.unpack_from(self._map, self._files_start + i * _FILE.size))
+                      for i in range(num_files)]
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, label):
+        return self._search(label) is not None
+
+    def get(self, label):
+        """
+        Returns the `LabelEntry` for `label`, or None if it isn't indexed.
+        """
+
+        record_num = self._search(label)
+
+        if record_num is None:
+            return None
+
+        return self._entry(record_num)
+
+    def keys(self, prefix=""):
+        """
+        Returns a sorted list of every indexed label that starts with `prefix`.
+        """
+
+        encoded = prefix.encode("utf-8")
+        record_num = self._lower_bound(encoded)
+
+        found = []
+
+        #labels with the prefix are all next to each other
+        while record_num < self.count:
+
+            label = self._label(record_num)
+
+            if not label.startswith(encoded):
+                break
+
+            found.append(label.decode("utf-8"))
+            record_num += 1
+
+        return found
+
+    def range(self, start_label, end_label):
+        """
+        Returns the entries from `start_label` to `end_label` in document order.
+
+        An empty list is returned if either label isn't indexed, or
+        if they are in different files.
+        """
+
+        start_num = self._search(start_label)
+        end_num = self._search(end_label)
+
+        if start_num is None or end_num is None:
+            return []
+
+        first = self._record(start_num)[7]
+        last = self._record(end_num)[7]
+
+        #the range has to be in one file
+        if self._record(start_num)[2] != self._record(end_num)[2]:
+            return []
+
+        return [self._entry(self._by_order(i)) for i in range(first, last + 1)]
+
+    def close(self):
+
+        self._map.close()
+        self._file.close()
+
+    #returns the record number for label, or None
+    def _search(self, label):
+
+        encoded = label.encode("utf-8")
+        record_num = self._lower_bound(encoded)
+
+        if record_num < self.count and self._label(record_num) == encoded:
+            return record_num
+
+        return None
+
+    #returns the first record number whose label is not less than encoded
+    def _lower_bound(self, encoded):
+
+        low = 0
+        high = self.count
+
+        while low < high:
+
+            mid = (low + high) // 2
+
+            if self._label(mid) < encoded:
+                low = mid + 1
+            else:
+                high = mid
+
+        return low
+
+    def _record(self, record_num):
+        return _RECORD.unpack_from(self._map, self._records_start + record_num * _RECORD.size)
+
+    #returns the record number of the equation at position order in document order
+    def _by_order(self, order):
+        return _ORDER.unpack_from(self._map, self._order_start + order * _ORDER.size)[0]
+
+    def _label(self, record_num):
+
+        label_offset, label_length = _RECORD.unpack_from(self._map, self._records_start + record_num * _RECORD.size)[:2]
+        start = self._strings_start + label_offset
+
+        return self._map[start:start + label_length]
+
+    def _string(self, offset, length):
+
+        start = self._strings_start + offset
+
+        return self._map[start:start + length].decode("utf-8")
+
+    def _entry(self, record_num):
+
+        label_offset, label_length, file_num, start, end, body_offset, body_length, order = self._record(record_num)
+
+        return LabelEntry(self._string(label_offset, label_length), self.files[file_num], start, end,
+                          self._string(body_offset, body_length))
+
+if __name__ == "__main__":
+    main()
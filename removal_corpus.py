@@ -0,0 +1,147 @@
+"""
+Checks that `remove_marked` gives the same result as the substitutions it replaced.
+
+Before `remove_marked`, marked text was removed from a processed
+document with three regular expression substitutions, one after
+another. Those substitutions are kept here, and both are run on a
+corpus made of a list of hand written documents covering the edge
+cases and documents generated from pieces of TeX, markers and
+whitespace with a fixed seed (so the corpus is the same every time).
+The module can be run directly:
+
+    python removal_corpus.py [count] [seed]
+
+Which prints every document that gives a different result, and exits
+with 1 if there were any. `count` is the number of generated
+documents (10000 by default).
+"""
+
+from __future__ import print_function
+
+import re
+import sys
+import random
+
+from utilities import REM_START, REM_END
+from find_annotations import remove_marked
+
+#number of generated documents checked by default
+DEFAULT_COUNT = 10000
+
+#seed the documents are generated with by default
+DEFAULT_SEED = 0
+
+#longest generated document, in pieces
+MAX_PIECES = 25
+
+#pieces generated documents are made of
+PIECES = [
+    "word",
+    ".",
+    " ",
+    "  ",
+    "\t",
+    "\n",
+    "{",
+    "}",
+    "\\begin{equation}",
+    "\\end{equation}",
+    "\\index{",
+    "\\index{x}",
+    "\\index{a}{b}",
+    REM_START,
+    REM_END
+]
+
+#documents for the cases remove_marked has to treat specially
+CASES = [
+    "",
+    "no markers at all\n",
+    "keep " + REM_START + "drop" + REM_END + " keep",
+    REM_START + "across\nseveral\nlines" + REM_END,
+    REM_START + "never closed",
+    "closed without being opened" + REM_END,
+    REM_START + REM_START + "twice" + REM_END + REM_END,
+    "\\begin{equation}\n  x = y" + REM_START + " when\n\\end{equation}" + REM_END,
+    "\\begin{equation}\n  x = y\n  " + REM_START + "z\n  \\end{equation}\nrest" + REM_END,
+    REM_START + "text \\index{kept}" + REM_END,
+    REM_START + "text \\index{kept}  \n " + REM_END + "after",
+    REM_START + "\\index{a}{b}" + REM_END,
+    REM_START + "\\index{unclosed" + REM_END,
+    "\\index{outside}" + REM_END + REM_START + "x" + REM_END,
+    REM_START + "one" + REM_END + "\\index{x}" + REM_START + "two\n\\end{equation}" + REM_END
+]
+
+def main():
+
+    count = DEFAULT_COUNT
+    seed = DEFAULT_SEED
+
+    if len(sys.argv) > 3:
+
+        print("Usage: {0} [count] [seed]".format(sys.argv[0]))
+        sys.exit(-1)
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        seed = int(sys.argv[2])
+
+    mismatches = 0
+    checked = 0
+
+    for content in iter_corpus(count, seed):
+
+        checked += 1
+        expected = remove_marked_subs(content)
+        actual = remove_marked(content)
+
+        if actual != expected:
+
+            mismatches += 1
+
+            print("Document: {0!r}".format(content))
+            print("\texpected: {0!r}".format(expected))
+            print("\tgot:      {0!r}".format(actual))
+
+    print("{0} of {1} documents differ".format(mismatches, checked))
+
+    if mismatches:
+        sys.exit(1)
+
+def iter_corpus(count=DEFAULT_COUNT, seed=DEFAULT_SEED):
+    """
+    Yields every document in CASES, then `count` documents generated with `seed`.
+    """
+
+    for content in CASES:
+        yield content
+
+    generator = random.Random(seed)
+
+    for i in range(count):
+        yield "".join(generator.choice(PIECES) for _ in range(generator.randint(0, MAX_PIECES)))
+
+def remove_marked_subs(content):
+    """
+    Removes the marked text in content with the three substitutions `remove_marked` replaced.
+    """
+
+    start = re.escape(REM_START)
+    end = re.escape(REM_END)
+
+    #only remove the marker if the rest of the line is the last line of an equation
+    removal_fix_pat = re.compile(r'(\s*)' + start + r'(.*?)\n(\s*)\\end{equation}')
+    content = removal_fix_pat.sub(r'\1\2\n\3\\end{equation}', content)
+
+    #keep an index at the end of the marked text
+    removal_fix_pat = re.compile(r'\\index{(.*?)}\s*' + end)
+    content = removal_fix_pat.sub(lambda match: REM_END + r'\index{' + match.group(1) + '}', content)
+
+    removal_pat = re.compile(start + '.*?' + end, re.DOTALL)
+
+    return removal_pat.sub('', content)
+
+if __name__ == "__main__":
+    main()
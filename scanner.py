@@ -0,0 +1,670 @@
+"""
+Finds the lines of TeX source that may hold annotations.
+
+Everything here works on strings and offsets only (there are no
+prompts and nothing is written), so other tools can import it and
+scan any number of files in one process. For example:::
+
+    scanner = AnnotationScanner()
+
+    for candidate in scanner.candidates(readin("ZE.tex")):
+        print(candidate.sentence, candidate.line, candidate.equations)
+
+"""
+
+import re
+import sys
+import time
+import hashlib
+from array import array
+from collections import namedtuple, OrderedDict
+
+from utilities import SentenceTable, PositionIndex, remove_inner_whitespace
+from label_index import iter_equations, equation_body
+
+#remap range function for python 3
+if int(sys.version[0]) >= 3:
+    xrange = range
+
+#words that often start an annotation (their lowercase forms are looked for too)
+INDICATORS = [
+    "When",
+    "Where",
+    "If",
+    "Then",
+    "For",
+    "With",
+    "As",
+    "Throughout",
+    "In",
+    "Over"
+]
+
+#most text (in bytes) looked through to build the context of one sentence
+MAX_SCAN_BYTES = 256 * 1024
+
+#most time (in seconds) spent building the context of one sentence
+MAX_SCAN_SECONDS = 1.0
+
+#most of a sentence (and of each sentence next to it) shown when it goes over its budget
+FALLBACK_BYTES = 4 * 1024
+
+#offsets of the sentences, equations (label to span), section commands and deletion boundaries in a document
+DocumentIndex = namedtuple("DocumentIndex", "sentences equations sections boundaries")
+
+#what a sentence looks like to the user: the text shown around it, where it starts in that text,
+#the labels of the equations it may be about, its lines that may hold annotations (and their offsets
+#in the sentence) and where deleting it should start
+SentenceScan = namedtuple("SentenceScan", "context sentence_loc equations lines ind_loc")
+
+#sentence number sentence (from start to end in the source) that went over its budget during stage,
+#after looking through scanned bytes in seconds
+Overrun = namedtuple("Overrun", "sentence start end stage scanned seconds")
+
+#a line that may hold an annotation, in sentence number sentence (marker_loc is the offset of the line in context)
+Candidate = namedtuple("Candidate", "sentence line context marker_loc equations")
+
+#strings that deleting a sentence stops at (or starts after)
+BOUNDARY_TOKENS = (r'\begin{equation}', r'\end{equation}', r'\index', "\n")
+
+#depth of each kind of section
+SECTION_LEVELS = {
+    "chapter": 0,
+    "section": 1,
+    "subsection": 2,
+    "subsubsection": 3
+}
+
+#matches one sentence
+_sentence_pat = re.compile(r'([^.!?\s][^.!?]*(?:[.!?](?!\s|$)[^.!?]*)*[.!?]?(?=\s|$))', re.DOTALL)
+
+#matches the start of a chapter, section or subsection
+_section_pat = re.compile(r'\\(?P<level>chapter|section|subsection|subsubsection)\*?{')
+
+#matches a label or a reference to one
+_label_pat = re.compile(r'\\(?:label|eqref){(?P<eq_id>eq:.*?)}')
+
+#matches a range of equations
+_eq_range_pat = re.compile(r'\\eqref{(?P<start>eq:(?P<main_name>.*?\..*?\..*?).+?)}\s*--\s*\\eqref{(?P<end>eq:.*?)}')
+
+#matches a variable defined by an equation
+_definition_pat = re.compile(r'\$(?P<var_name>.)\$ defined by \\eqref{(?P<eq_id>.*?)}')
+
+#matches blank lines
+_blank_lines_pat = re.compile(r'\n{2,}')
+
+#matches inline math
+_math_pat = re.compile(r'\$.*?\$', re.DOTALL)
+
+#matches a reference to (or definition of) a label
+_reference_pat = re.compile(r'\\(label|eqref|ref){.*?}')
+
+class AnnotationScanner(object):
+    """
+    Finds the lines that may hold annotations, and the context and equations for each.
+
+    The indicators (and a pattern matching any of them, used to pass
+    over sentences without one quickly) are only built when the
+    scanner is made or its indicators change, so one scanner can be
+    used for any number of documents. If `corpus` (a `LabelIndex`) is
+    given, equations that aren't in a document are looked up in it.
+
+    Building the context of a sentence stops once `max_bytes` of text
+    have been looked through or `max_seconds` have passed, and up to
+    `fallback_bytes` of the sentence (from its first indicator) is
+    shown with as much of each of its neighbours instead. Each time
+    that happens an `Overrun` is stored in `overruns` under the number
+    of the sentence (replacing the one from an earlier scan of it).
+    """
+
+    def __init__(self, indicators=INDICATORS, corpus=None, max_bytes=MAX_SCAN_BYTES, max_seconds=MAX_SCAN_SECONDS,
+                 fallback_bytes=FALLBACK_BYTES):
+
+        self.corpus = corpus
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.fallback_bytes = fallback_bytes
+        self.overruns = {}
+        self.set_indicators(list(indicators) + [indicator.lower() for indicator in indicators])
+
+    def set_indicators(self, indicators):
+        """
+        Looks for `indicators` (in order) from now on.
+        """
+
+        self.indicators = list(indicators)
+
+        alternatives = "|".join(re.escape(indicator) for indicator in self.indicators)
+
+        #anything find_annotation_lines would find has one of these in it
+        self._indicator_pat = re.compile(r'(?:^|\n)(?:{0})|\s(?:{0})[ .]'.format(alternatives))
+
+    def add_indicator(self, keyword):
+        """
+        Looks for `keyword` (and its title case form) as well from now on.
+        """
+
+        self.set_indicators(self.indicators + [keyword, keyword.title()])
+
+    def index(self, content):
+        """
+        Returns a `DocumentIndex` of content (see `index_document`).
+        """
+
+        return index_document(content)
+
+    def find_lines(self, sentence):
+        """
+        Returns the result of `find_annotation_lines` for `sentence` with the scanner's indicators.
+        """
+
+        #no indicator anywhere in the sentence
+        if not self.indicators or not self._indicator_pat.search(sentence):
+            return [], 0
+
+        return find_annotation_lines(sentence, self.indicators)
+
+    def sentence_lines(self, sentences, snum):
+        """
+        Returns the lines of sentence `snum` that may hold annotations, without looking at its context.
+
+        The lines are in the form given by `find_annotation_lines`.
+        """
+
+        return self.find_lines(normalize_sentence(sentences[snum].group()))[0]
+
+    def scan_lines(self, document, snum):
+        """
+        Returns the lines of sentence `snum` in `document` that may hold annotations, as `scan` finds them.
+
+        Unlike `sentence_lines`, the lines are those of the sentence
+        after it has been cut to a section or range and its "defined
+        by" references replaced, so they are the lines that are asked
+        about. None of the context is built, so this is much faster
+        than `scan` (and only differs from it for sentences that go
+        over the budget while their context is being built).
+        """
+
+        budget = _Budget(self.max_bytes, self.max_seconds)
+
+        #the sentence is cut and has its definitions replaced just like in scan, but none of its context is built
+        try:
+            scan = self._scan(document, snum, budget, with_context=False)
+        except _OverBudget:
+            scan = self._bounded_scan(document, snum)
+
+        if scan is None:
+            return []
+
+        return scan.lines
+
+    def scan(self, document, snum):
+        """
+        Returns a `SentenceScan` of sentence `snum` in `document`, or None if no line may hold an annotation.
+
+        Sentences that refer to "this section" (or subsection or
+        chapter) are shown with the rest of the section, ranges of
+        equations are shown in full and variables defined by an
+        equation are replaced with the equation. If that goes over
+        the scanner's budget, only the part of the sentence around its
+        first indicator is shown between the ends of the sentences
+        next to it (each cut to `fallback_bytes`) instead.
+        """
+
+        budget = _Budget(self.max_bytes, self.max_seconds)
+
+        try:
+            return self._scan(document, snum, budget)
+        except _OverBudget as error:
+
+            sentence = document.sentences[snum]
+            self.overruns[snum] = Overrun(snum, sentence.start(), sentence.end(), error.stage, budget.scanned, budget.elapsed())
+
+            return self._bounded_scan(document, snum)
+
+    #builds the full context of sentence snum (see scan), spending budget on the text looked through
+    #(only the sentence itself is looked at if with_context is False)
+    def _scan(self, document, snum, budget, with_context=True):
+
+        every_sentence = document.sentences
+        num_sentences = len(every_sentence)
+        equations = document.equations
+        source = every_sentence.source
+        corpus = self.corpus
+
+        assoc_equations = []
+
+        #lines showing the equations of ranges in other files
+        other_equations = []
+
+        sentence = every_sentence[snum].group()
+
+        before = ""
+        after = ""
+
+        #sentences next to this one (counted whether or not they are used, so the budget runs out the same way)
+        neighbours = [every_sentence[i] for i in (snum - 1, snum + 1) if 0 <= i < num_sentences]
+
+        #this isn't the first sentence, get the previous sentence
+        if snum != 0 and with_context:
+            before = every_sentence[snum - 1].group()
+
+        #this isn't the last sentence, get the next sentence
+        if snum != num_sentences - 1 and with_context:
+            after = every_sentence[snum + 1].group()
+
+        sentence = normalize_sentence(sentence)
+
+        budget.spend("segmentation", len(sentence) + sum(_length(neighbour) for neighbour in neighbours))
+
+        sectioning = ""
+
+        #see if the section or subsection is referenced
+        if "this subsection" in sentence:
+            sectioning = "subsection"
+        if "this section" in sentence:
+            sectioning = "section"
+        if "this chapter" in sentence:
+            sectioning = "chapter"
+
+        #either the seciton or subsection was referenced
+        if sectioning and not with_context:
+            sentence = sentence[sentence.find("\\" + sectioning):]
+
+        elif sectioning:
+
+            before = ""
+            sentence = sentence[sentence.find("\\" + sectioning):]
+
+            line_ind = snum + 1
+
+            #find the sentence where the next section starts
+            while (line_ind < num_sentences - 1
+                and ("\\" + sectioning) not in every_sentence[line_ind]):
+
+                budget.spend("section", _length(every_sentence[line_ind]))
+
+                line_ind += 1
+
+            #take every sentence up to there in one slice
+            after = every_sentence[snum + 1:line_ind + 1]
+
+            to_join = []
+
+            after_lines = after.split("\n")
+            line_ind = 0
+            current = after_lines[line_ind]
+
+            #keep adding lines until the start of the next section
+            while (("\\" + sectioning) not in current
+                and line_ind + 1 < len(after_lines)):
+
+                to_join.append(current)
+
+                line_ind += 1
+                current = after_lines[line_ind]
+
+            to_join.append(current)
+
+            after = '\n'.join(to_join)
+
+        found_range = False
+
+        #include ranges of equations if they are referenced
+        for match in _eq_range_pat.finditer(sentence):
+
+            found_range = True
+
+            current = snum + 2
+            start_id = match.group("start")
+            end_id = match.group("end")
+            main_name = match.group("main_name")
+
+            end_label = r'\label{' + end_id + '}'
+
+            to_join = [after]
+
+            #nothing is looked up if only the sentence is wanted
+            found_end = not with_context or end_label in after
+
+            #the range is in another file, so look it up instead of searching the rest of this one
+            #(its equations are shown, but can't be annotated here, so their labels are left out)
+            if end_id not in equations and corpus is not None and with_context:
+
+                for entry in corpus.range(start_id, end_id):
+
+                    budget.spend("range", len(entry.body))
+
+                    other_equations.append("%{0} (in {1}): {2}".format(entry.label, entry.file, " ".join(entry.body.split())))
+                    found_end = True
+
+            #keep adding to after until we have the whole range
+            while current < num_sentences and not found_end:
+
+                to_add = every_sentence[current]
+
+                budget.spend("range", _length(to_add))
+
+                #only add if it has a relevant equation in it
+                if r'\label{' not in to_add or main_name in to_add:
+
+                    to_join.append(to_add.group())
+                    found_end = end_label in to_add
+
+                current += 1
+
+            after = ''.join(to_join)
+
+            before = ""
+            start_loc = sentence.find(r'\begin{equation}\label{' + start_id + '}')
+
+            #first equation is in this sentence
+            if start_loc != -1:
+                sentence = sentence[start_loc:]
+            else:
+                start_loc = after.find(r'\begin{equation}\label{' + start_id + '}')
+
+        #found an equation range, cut out after after last end equaiton
+        if found_range and r'\end{equation}' in after:
+            after = after[:after.rfind(r'\end{equation}') + len(r'\end{equation}')]
+
+        #show the equations of ranges in other files after the ones in this one
+        if other_equations:
+            after = "\n".join([after] + other_equations)
+
+        #if variable is defined by an equation, replace eqref with text
+        for match in _definition_pat.finditer(sentence):
+
+            eq_id = match.group("eq_id")
+            body = None
+
+            #equation is in this file
+            if eq_id in equations:
+                eq_start, eq_end = equations[eq_id]
+                body = equation_body(source[eq_start:eq_end])
+
+            #the equation isn't in this file, try the other files
+            if body is None and corpus is not None:
+
+                entry = corpus.get(eq_id)
+
+                if entry is not None:
+                    body = entry.body
+
+            #make sure we found something
+            if body is not None:
+
+                #every replacement copies the sentence
+                budget.spend("definition", len(sentence) + len(body))
+
+                sentence = sentence.replace(r'\eqref{' + eq_id + '}', body.strip().rstrip("."))
+
+        context = "\n".join([before, sentence, after])
+
+        #find the equation ids of all the equations that may be associated with this annotation
+        for label_match in _label_pat.finditer(context):
+            assoc_equations.append(label_match.group("eq_id"))
+
+        #take out the eq labels from the range if they exist
+        if found_range:
+            assoc_equations = assoc_equations[2:]
+
+        #annotations can only be put in equations in this document
+        assoc_equations = [label for label in assoc_equations if label in equations]
+
+        annotation_lines, ind_loc = self.find_lines(sentence)
+
+        #don't do anything else if there aren't any indicators in the sentence
+        if not annotation_lines:
+            return None
+
+        #the sentence starts right after before and its newline in context
+        return SentenceScan(context, len(before) + 1, assoc_equations, annotation_lines, ind_loc)
+
+    #returns a SentenceScan of at most fallback_bytes of sentence snum with only the sentences next to it as context
+    def _bounded_scan(self, document, snum):
+
+        every_sentence = document.sentences
+        size = self.fallback_bytes
+
+        sentence = normalize_sentence(every_sentence[snum].group())
+
+        indicator_match = self._indicator_pat.search(sentence)
+
+        if indicator_match is None:
+            return None
+
+        #start at the line with the first indicator (or just before the indicator if the line is too long)
+        window_start = sentence.rfind("\n", 0, indicator_match.start()) + 1
+        window_start = max(window_start, indicator_match.start() - size // 2)
+
+        window = sentence[window_start:window_start + size]
+
+        annotation_lines, ind_loc = self.find_lines(window)
+
+        if not annotation_lines:
+            return None
+
+        #lines are found in the window, but deletion starts from the same place in the sentence
+        #(the start of the line if the window starts partway through it)
+        if ind_loc == 0:
+            ind_loc = sentence.rfind("\n", 0, window_start) + 1
+        else:
+            ind_loc += window_start
+
+        sentence = window
+
+        before = ""
+        after = ""
+
+        if snum != 0:
+            before = _tail(every_sentence[snum - 1], size)
+
+        if snum != len(every_sentence) - 1:
+            after = _head(every_sentence[snum + 1], size)
+
+        context = "\n".join([before, sentence, after])
+
+        assoc_equations = [label_match.group("eq_id") for label_match in _label_pat.finditer(context)
+                           if label_match.group("eq_id") in document.equations]
+
+        return SentenceScan(context, len(before) + 1, assoc_equations, annotation_lines, ind_loc)
+
+    def candidates(self, content, document=None, start=0):
+        """
+        Yields a `Candidate` for every line in content that may hold an annotation.
+
+        `document` is the `DocumentIndex` of content (it is made if
+        not given), and sentences before `start` are passed over.
+        """
+
+        if document is None:
+            document = self.index(content)
+
+        for snum in xrange(start, len(document.sentences)):
+
+            scan = self.scan(document, snum)
+
+            if scan is None:
+                continue
+
+            for line, line_loc in scan.lines:
+                yield Candidate(snum, line, scan.context, scan.sentence_loc + line_loc, list(scan.equations))
+
+class _OverBudget(Exception):
+    """
+    Raised when building the context of a sentence goes over its budget.
+    """
+
+    def __init__(self, stage):
+
+        Exception.__init__(self, stage)
+        self.stage = stage
+
+class _Budget(object):
+    """
+    Text looked through, and time spent, building the context of one sentence.
+    """
+
+    def __init__(self, max_bytes, max_seconds):
+
+        self.max_bytes = max_bytes
+        self.started = time.time()
+        self.deadline = self.started + max_seconds
+        self.scanned = 0
+
+    def spend(self, stage, size):
+        """
+        Counts `size` more bytes looked through, raising _OverBudget if the budget is used up.
+        """
+
+        self.scanned += size
+
+        if self.scanned > self.max_bytes or time.time() > self.deadline:
+            raise _OverBudget(stage)
+
+    def elapsed(self):
+        """
+        Returns the number of seconds since the budget was made.
+        """
+
+        return time.time() - self.started
+
+#returns the length of a sentence (from a SentenceTable) without copying it
+def _length(sentence):
+    return sentence.end() - sentence.start()
+
+#returns up to the last size characters of a sentence
+def _tail(sentence, size):
+
+    source = sentence.table.source
+
+    return source[max(sentence.start(), sentence.end() - size):sentence.end()]
+
+#returns up to the first size characters of a sentence
+def _head(sentence, size):
+
+    source = sentence.table.source
+
+    return source[sentence.start():min(sentence.end(), sentence.start() + size)]
+
+def index_document(content):
+    """
+    Returns a `DocumentIndex` of the sentences, equations and sections in content.
+
+    Sentences are only looked for after \\begin{document}, and each
+    equation label is mapped to the span of the first equation with it.
+    """
+
+    doc_start = content.find("\\begin{document}")
+
+    #sentence offsets are relative to the start of content
+    sentences = SentenceTable(content, _sentence_pat, doc_start)
+
+    equations = OrderedDict()
+
+    for label, eq_start, eq_end, body in iter_equations(content):
+        equations.setdefault(label, (eq_start, eq_end))
+
+    sections = array("l", (match.start() for match in _section_pat.finditer(content)))
+
+    return DocumentIndex(sentences, equations, sections, PositionIndex(content, BOUNDARY_TOKENS))
+
+def normalize_sentence(sentence):
+    """
+    Returns `sentence` without surrounding whitespace or blank lines.
+    """
+
+    return _blank_lines_pat.sub("\n", sentence.strip())
+
+def find_annotation_lines(sentence, indicators):
+    """
+    Finds the lines of `sentence` that contain one of `indicators`.
+
+    Returns a list of ("<indicator>: <line>", offset of line in
+    sentence) tuples, and the offset of the earliest line found for
+    any indicator (where deletion should start), which doesn't depend
+    on the order of `indicators`.
+    """
+
+    annotation_lines = []
+
+    seen = set()
+
+    #go through each indicator
+    for indicator in indicators:
+
+        line_loc = 0
+
+        #go through each line in the sentence so we can print out the one with the indicator
+        for line in sentence.split("\n"):
+
+            #store each line that may contain an annotation (and where it starts in the sentence)
+            if (line not in seen
+                and (" " + indicator + " " in line)
+                or (indicator + " " in line and line.startswith(indicator))
+                or (" " + indicator + ". " in line)):
+
+                annotation_lines.append(("{0}: {1}".format(indicator, line.lstrip()), line_loc))
+                seen.add(line)
+
+            line_loc += len(line) + 1
+
+    #start at the end of the sentence if nothing was found
+    ind_loc = len(sentence) + 1
+
+    if annotation_lines:
+        ind_loc = min(line_loc for line, line_loc in annotation_lines)
+
+    return annotation_lines, ind_loc
+
+def section_level(source, offset):
+    """
+    Returns the depth (from SECTION_LEVELS) of the section command at `offset` in `source`.
+    """
+
+    return SECTION_LEVELS[_section_pat.match(source, offset).group("level")]
+
+def math_spans(line):
+    """
+    Returns a list of the inline math in `line`.
+    """
+
+    return _math_pat.findall(line)
+
+def line_indicator(line):
+    """
+    Returns the indicator that found `line` (in the form given by `find_annotation_lines`).
+    """
+
+    return line[:line.find(": ")]
+
+def line_position(line):
+    """
+    Returns "start" if `line` starts with the indicator that found it, and "inside" otherwise.
+    """
+
+    indicator = line_indicator(line)
+
+    if line[len(indicator) + 2:].startswith(indicator):
+        return "start"
+
+    return "inside"
+
+def cluster_key(line):
+    """
+    Returns the key of the cluster that annotation `line` belongs to.
+
+    `line` is in the form given by `find_annotation_lines`. Lines
+    that only differ in their indicator, in whitespace (including
+    inside math), in the labels they refer to, or in trailing
+    punctuation have the same key.
+    """
+
+    text = remove_inner_whitespace(line[line.find(": ") + 2:].strip())
+
+    text = _reference_pat.sub(r'\\\1{}', text)
+    text = _math_pat.sub(lambda match: re.sub(r'\s+', '', match.group()), text)
+    text = text.rstrip(".,;:")
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,272 @@
+"""
+Keeps the state of each session in its own directory.
+
+Every input file gets a directory (under STATE_DIR) named after its
+path, holding the progress, save and snapshot files for that file.
+The directory is locked while a session is using it, so any number
+of files can be processed side by side from the same checkout, but
+the same file can't be processed by two sessions at once.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+#directory that every session directory is kept in
+STATE_DIR = ".annotations"
+
+#sessions that haven't been touched in this many days are removed
+STALE_DAYS = 30
+
+#name of the lock file in each session directory
+LOCK_FILE = "lock"
+
+#name of the file recording which input a session is for
+INPUT_FILE = "input"
+
+#times a session tries to take its lock before giving up
+LOCK_ATTEMPTS = 5
+
+#seconds between tries to take the lock
+LOCK_WAIT = 0.1
+
+class SessionLocked(Exception):
+    """
+    Raised when another process is already using a session.
+    """
+
+class Session(object):
+    """
+    State directory for processing one input file.
+
+    For example:::
+
+        session = Session("chapters/ZE.tex")
+        session.acquire()
+
+        session.path(".save")    #returns ".annotations/ZE.tex-<hash>/.save"
+
+    """
+
+    def __init__(self, input_path, root=STATE_DIR):
+
+        self.root = root
+        self.input_path = os.path.abspath(input_path)
+
+        key = hashlib.sha1(self.input_path.encode("utf-8")).hexdigest()[:12]
+
+        self.directory = os.path.join(root, "{0}-{1}".format(os.path.basename(self.input_path), key))
+        self._lock = None
+
+    def path(self, name):
+        """
+        Returns the path of the state file `name` for this session.
+        """
+
+        return os.path.join(self.directory, name)
+
+    def shared_path(self, name):
+        """
+        Returns the path of the file `name` shared by every session.
+        """
+
+        return os.path.join(self.root, name)
+
+    def acquire(self):
+        """
+        Creates the session directory if necessary and locks it.
+
+        Raises SessionLocked if another process holds the lock.
+        """
+
+        lock = None
+        error = None
+
+        #another process's clean_stale_sessions may be holding the lock for a moment, or have just removed the directory
+        for attempt in range(LOCK_ATTEMPTS):
+
+            if attempt:
+                time.sleep(LOCK_WAIT)
+
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+            try:
+                lock = _try_lock(self.path(LOCK_FILE))
+                error = None
+            except (IOError, OSError) as open_error:
+                error = open_error
+                continue
+
+            if lock is not None:
+                break
+
+        if error is not None:
+            raise error
+
+        if lock is None:
+            raise SessionLocked("{0} is already being processed by another session".format(self.input_path))
+
+        self._lock = lock
+
+        #remember the input so stale sessions can be found
+        with open(self.path(INPUT_FILE), "w") as out:
+            out.write(self.input_path)
+
+    def release(self):
+        """
+        Unlocks the session directory.
+        """
+
+        if self._lock is not None:
+            _unlock(self._lock)
+            self._lock = None
+
+def clean_stale_sessions(root=STATE_DIR, max_age=STALE_DAYS * 24 * 60 * 60):
+    """
+    Removes the session directories in `root` that are no longer needed.
+
+    A session is stale if no process has it locked and either its
+    input file no longer exists, or none of its files have been
+    changed in `max_age` seconds. Directories that don't record their
+    input yet (they may be being set up by another process) are only
+    removed by age. Returns the number removed.
+    """
+
+    if not os.path.isdir(root):
+        return 0
+
+    removed = 0
+    now = time.time()
+
+    for name in os.listdir(root):
+
+        directory = os.path.join(root, name)
+
+        if not os.path.isdir(directory):
+            continue
+
+        #don't create a lock file in a directory that is being removed
+        try:
+            lock = _try_lock(os.path.join(directory, LOCK_FILE))
+        except (IOError, OSError):
+            continue
+
+        #someone is still using it
+        if lock is None:
+            continue
+
+        try:
+
+            input_path = None
+
+            try:
+                with open(os.path.join(directory, INPUT_FILE)) as in_file:
+                    input_path = in_file.read().strip()
+            except IOError:
+                pass
+
+            last_change = max(os.path.getmtime(os.path.join(directory, f)) for f in os.listdir(directory))
+
+            #input is gone or session hasn't been used in a long time
+            if (input_path is not None and not os.path.exists(input_path)) or now - last_change > max_age:
+                shutil.rmtree(directory, ignore_errors=True)
+                removed += 1
+
+        finally:
+            _unlock(lock)
+
+    return removed
+
+@contextmanager
+def file_lock(filename):
+    """
+    Holds an exclusive lock on the file `filename` (waiting for it if necessary) inside the block.
+
+    The file is created if it doesn't exist. For example:::
+
+        with file_lock(".annotations/indicators.json.lock"):
+            ...    #read, change and write the shared file
+
+    """
+
+    lock = open(filename, "a")
+
+    try:
+        _lock_file(lock, wait=True)
+    except BaseException:
+        lock.close()
+        raise
+
+    try:
+        yield
+    finally:
+        _unlock(lock)
+
+#returns an open lock file if it could be locked without waiting (or None)
+def _try_lock(filename):
+
+    lock = open(filename, "a")
+
+    try:
+        _lock_file(lock)
+    except (IOError, OSError):
+        lock.close()
+        return None
+
+    return lock
+
+#unlocks and closes a lock file from _try_lock
+def _unlock(lock):
+
+    try:
+        _unlock_file(lock)
+    except (IOError, OSError):
+        pass
+
+    lock.close()
+
+#locks are taken with fcntl on unix and msvcrt on windows
+try:
+
+    import fcntl
+
+    def _lock_file(lock, wait=False):
+
+        flags = fcntl.LOCK_EX
+
+        if not wait:
+            flags |= fcntl.LOCK_NB
+
+        fcntl.flock(lock.fileno(), flags)
+
+    def _unlock_file(lock):
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+except ImportError:
+
+    import msvcrt
+
+    def _lock_file(lock, wait=False):
+
+        lock.seek(0)
+
+        #LK_LOCK only retries for about 10 seconds, so keep trying
+        if wait:
+            while True:
+                try:
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                    return
+                except (IOError, OSError):
+                    pass
+
+        msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+
+    def _unlock_file(lock):
+        lock.seek(0)
+        msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
@@ -7,11 +7,45 @@ from __future__ import print_function
 import re
 import sys
 import os
+import gzip
+import json
+import hashlib
+import shutil
+import difflib
+import tempfile
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+#tab completion is only available where there is readline
+try:
+    import readline
+except ImportError:
+    readline = None
+
+#snapshots are compressed with lzma where it's available (python 3)
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 #remap input function if necessary
 if int(sys.version[0]) >= 3:
     raw_input = input
+    xrange = range
 
+#size of the pieces that documents are written out in
+CHUNK_SIZE = 1 << 16
+
+#os.replace overwrites on every platform, but is only in python 3
+_replace = getattr(os, "replace", os.rename)
+
+#snapshots written with a different version are ignored
+SNAPSHOT_VERSION = 1
+
+#markers placed around text that should be removed
+REM_START = "~~~~REM_START~~~~"
+REM_END = "~~~~REM_END~~~~"
 
 def debug(function):
     """
@@ -27,7 +61,7 @@ def debug(function):
 
     return inner
 
-def get_input(prompt, valid=None, list=False, wait=True, preserve_case=False):
+def get_input(prompt, valid=None, list=False, wait=True, preserve_case=False, completer=None):
     """
     Requests input from stdin until a valid response is given.
 
@@ -40,7 +74,9 @@ def get_input(prompt, valid=None, list=False, wait=True, preserve_case=False):
     determined character by character, otherwise, it will be
     determined by word. If `wait` is True, will wait for the
     user to press return. Otherwise, will accept first
-    typed character as input (using getch).
+    typed character as input (using getch). If a `completer` (such
+    as a `LabelTrie`) is given, pressing tab while typing will complete
+    the response with it.
 
     For example:::
   
@@ -92,22 +128,24 @@ def get_input(prompt, valid=None, list=False, wait=True, preserve_case=False):
     if not prompt.endswith(" "):
         prompt = prompt + " "
 
-        response = input_function(prompt) 
-    
     #add spaces and commas to the valid characters for a list
     if list:
         valid.add(",")
         valid.add(" ")
 
-    #keep asking for input until a valid response is given
-    while (valid and 
-        (any(char not in valid for char in response.lower()) or not list)
-        and (response.lower() not in valid or list)
-        or response.strip() == ""):
+    with _completion(completer if wait else None):
 
-        print("That is not a valid response. Please try again.")
         response = input_function(prompt) 
 
+        #keep asking for input until a valid response is given
+        while (valid and 
+            (any(char not in valid for char in response.lower()) or not list)
+            and (response.lower() not in valid or list)
+            or response.strip() == ""):
+
+            print("That is not a valid response. Please try again.")
+            response = input_function(prompt) 
+
     to_return = response.lower()
     
     #give response as typed if preserve case specified
@@ -116,6 +154,32 @@ def get_input(prompt, valid=None, list=False, wait=True, preserve_case=False):
 
     return to_return
 
+#uses completer for tab completion in raw_input while inside the block
+@contextmanager
+def _completion(completer):
+
+    if completer is None or readline is None:
+        yield
+        return
+
+    old_completer = readline.get_completer()
+    old_delims = readline.get_completer_delims()
+
+    readline.set_completer(completer.complete)
+    readline.set_completer_delims(" \t\n")
+
+    #libedit (used on OS X) has its own syntax for key bindings
+    if "libedit" in (readline.__doc__ or ""):
+        readline.parse_and_bind("bind ^I rl_complete")
+    else:
+        readline.parse_and_bind("tab: complete")
+
+    try:
+        yield
+    finally:
+        readline.set_completer(old_completer)
+        readline.set_completer_delims(old_delims)
+
 def readin(filename):
     """
     Returns the content of filename as a list of lines.
@@ -138,6 +202,209 @@ def writeout(filename, content, append=False):
     with open(filename, mode) as out:
         out.write(content)
 
+def writeout_atomic(filename, chunks, binary=False):
+    """
+    Writes the strings in `chunks` to file filename, replacing it atomically.
+
+    The chunks are written one at a time to a temporary file in the
+    same directory as filename, which is then renamed to filename.
+    If anything goes wrong, the temporary file is removed and
+    filename is left as it was. If `binary` is True, the chunks
+    should be bytes.
+    """
+
+    mode = "w"
+
+    if binary:
+        mode = "wb"
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    prefix = "." + os.path.basename(filename) + "."
+
+    fd, temp_name = tempfile.mkstemp(prefix=prefix, suffix=".tmp", dir=directory)
+
+    try:
+
+        #write each chunk as it is produced
+        with os.fdopen(fd, mode) as out:
+            for chunk in chunks:
+                out.write(chunk)
+
+        _copy_mode(temp_name, filename)
+        _replace(temp_name, filename)
+
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+#gives temporary file temp_name the permissions of filename, or the default ones if it doesn't exist yet
+def _copy_mode(temp_name, filename):
+
+    try:
+        shutil.copymode(filename, temp_name)
+    except OSError:
+
+        #mkstemp only lets the owner read the file, so apply the umask instead
+        umask = os.umask(0)
+        os.umask(umask)
+
+        os.chmod(temp_name, 0o666 & ~umask)
+
+def iter_chunks(content, size=CHUNK_SIZE):
+    """
+    Yields content in pieces of at most `size` characters.
+    """
+
+    for start in xrange(0, len(content), size):
+        yield content[start:start + size]
+
+def iter_patch(original, updated, from_name="", to_name=""):
+    """
+    Yields the lines of a unified diff that turns `original` into `updated`.
+    """
+
+    diff = difflib.unified_diff(original.splitlines(True), updated.splitlines(True), from_name, to_name)
+
+    #make sure a missing newline at the end doesn't merge two lines of the patch
+    for line in diff:
+
+        if not line.endswith("\n"):
+            line += "\n\\ No newline at end of file\n"
+
+        yield line
+
+def save_snapshot(filename, source, arrays, **fields):
+    """
+    Saves `arrays` and `fields` describing `source` to file filename.
+
+    `arrays` is a dictionary of `array`s and `fields` holds any other
+    values (which have to be JSON serializable). The snapshot is
+    compressed and remembers a hash of `source`, so `load_snapshot`
+    will only return it for exactly the same text.
+    """
+
+    names = sorted(arrays)
+
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "hash": _hash_text(source),
+        "arrays": [[name, arrays[name].typecode, arrays[name].itemsize, len(arrays[name])] for name in names],
+        "fields": fields
+    }
+
+    chunks = [json.dumps(header).encode("utf-8"), b"\n"]
+    chunks.extend(_array_bytes(arrays[name]) for name in names)
+
+    data = b"".join(chunks)
+
+    #compress as well as we can
+    if lzma is not None:
+        data = lzma.compress(data)
+    else:
+        data = gzip_compress(data)
+
+    writeout_atomic(filename, [data], binary=True)
+
+def load_snapshot(filename, source):
+    """
+    Returns the arrays and fields saved in snapshot filename for `source`.
+
+    The whole file is read at once. None is returned if the file is
+    missing or damaged, or if it was saved for anything other than
+    `source`.
+    """
+
+    try:
+
+        with open(filename, "rb") as snapshot:
+            data = snapshot.read()
+
+        #lzma and gzip streams start differently
+        if data.startswith(b"\x1f\x8b"):
+            data = gzip_decompress(data)
+        elif lzma is not None:
+            data = lzma.decompress(data)
+        else:
+            return None
+
+        header_end = data.index(b"\n")
+        header = json.loads(data[:header_end].decode("utf-8"))
+
+        #snapshot is out of date
+        if header["version"] != SNAPSHOT_VERSION or header["hash"] != _hash_text(source):
+            return None
+
+        arrays = {}
+        position = header_end + 1
+
+        #read each array back in the order it was written
+        for name, typecode, itemsize, length in header["arrays"]:
+
+            values = array(typecode)
+
+            #arrays were written on a machine with different sizes
+            if values.itemsize != itemsize:
+                return None
+
+            end = position + itemsize * length
+
+            if end > len(data):
+                return None
+
+            _array_extend(values, data[position:end])
+            arrays[name] = values
+
+            position = end
+
+        return arrays, header["fields"]
+
+    except Exception:
+        return None
+
+def gzip_compress(data):
+    """
+    Returns bytes `data` compressed in the gzip format.
+    """
+
+    import io
+
+    buffer = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as compressed:
+        compressed.write(data)
+
+    return buffer.getvalue()
+
+def gzip_decompress(data):
+    """
+    Returns gzip compressed bytes `data` decompressed.
+    """
+
+    import io
+
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode="rb") as compressed:
+        return compressed.read()
+
+#returns a hash of a string of text
+def _hash_text(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+#returns the contents of an array as bytes (tostring was renamed in python 3)
+def _array_bytes(values):
+
+    if hasattr(values, "tobytes"):
+        return values.tobytes()
+
+    return values.tostring()
+
+#adds the values in bytes data to an array
+def _array_extend(values, data):
+
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+
 def get_line_lengths(content):
     """
     Returns a list of the total number of bytes before the end of each line in content.
@@ -264,6 +531,391 @@ def _find_line_helper(byte, line_lengths, start, end):
 
     return _find_line_helper(byte, line_lengths, next_start, next_end)
 
+class SentenceTable(object):
+    """
+    Compact table of the sentences in a string.
+
+    Only the start and end offsets of each sentence are stored (in two
+    parallel arrays), and the text is sliced out of `source` on demand.
+    Indexing with an integer returns a `Sentence` view, which supports
+    the `group`, `start` and `end` methods of a regex match (and `in`
+    tests that search the source without copying it). Indexing
+    with a slice returns the source text running from the start of the
+    first sentence to the end of the last one in a single slice.
+
+    For example:::
+
+        table = SentenceTable("One. Two. Three.", sentence_pat)
+
+        table[1].group()    #returns "Two."
+        table[0:2]          #returns "One. Two."
+
+    """
+
+    __slots__ = ("source", "starts", "ends")
+
+    def __init__(self, source, pattern, pos=0):
+
+        self.source = source
+        self.starts = array("l")
+        self.ends = array("l")
+
+        #only keep the offsets of each match
+        for match in pattern.finditer(source, pos):
+            self.starts.append(match.start())
+            self.ends.append(match.end())
+
+    @classmethod
+    def from_offsets(cls, source, starts, ends):
+        """
+        Returns a table for `source` made from already known offsets.
+        """
+
+        table = cls.__new__(cls)
+
+        table.source = source
+        table.starts = starts
+        table.ends = ends
+
+        return table
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+
+        for index in xrange(len(self.starts)):
+            yield Sentence(self, index)
+
+    def __getitem__(self, index):
+
+        #slices are turned into one contiguous piece of the source
+        if isinstance(index, slice):
+
+            first, last, step = index.indices(len(self.starts))
+
+            if first >= last:
+                return ""
+
+            return self.source[self.starts[first]:self.ends[last - 1]]
+
+        if index < 0:
+            index += len(self.starts)
+
+        if not 0 <= index < len(self.starts):
+            raise IndexError("sentence index out of range")
+
+        return Sentence(self, index)
+
+class Sentence(object):
+    """
+    View of a single sentence in a `SentenceTable`.
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+
+        self.table = table
+        self.index = index
+
+    def start(self):
+        return self.table.starts[self.index]
+
+    def end(self):
+        return self.table.ends[self.index]
+
+    def group(self):
+        return self.table.source[self.start():self.end()]
+
+    def __contains__(self, sub):
+        return self.table.source.find(sub, self.start(), self.end()) != -1
+
+class PositionIndex(object):
+    """
+    Offsets of every occurrence of each of a few strings in a larger string.
+
+    The offsets are all found when the index is made, so
+    `find` can then be answered with a binary search instead of by
+    searching (or slicing) the source.
+
+    For example:::
+
+        positions = PositionIndex("a\\index{b}\\index{c}", ["\\index"])
+
+        positions.find("\\index", 2, 20)    #returns 10, like source.find
+
+    """
+
+    __slots__ = ("tokens", "offsets")
+
+    def __init__(self, source, tokens=()):
+
+        self.tokens = list(tokens)
+        self.offsets = [array("l", (match.start() for match in re.finditer(re.escape(token), source)))
+                        for token in self.tokens]
+
+    @classmethod
+    def from_offsets(cls, tokens, offsets):
+        """
+        Returns an index made from already known offsets (one array for each of `tokens`).
+        """
+
+        positions = cls.__new__(cls)
+
+        positions.tokens = list(tokens)
+        positions.offsets = list(offsets)
+
+        return positions
+
+    def find(self, token, start, end):
+        """
+        Returns the first offset of `token` that is entirely within `start` and `end`, or -1.
+
+        Gives the same result as `source.find(token, start, end)`
+        for a non-negative `start`.
+        """
+
+        offsets = self.offsets[self.tokens.index(token)]
+        index = bisect_left(offsets, start)
+
+        #later occurrences would end even further along
+        if index < len(offsets) and offsets[index] + len(token) <= end:
+            return offsets[index]
+
+        return -1
+
+class LabelTrie(object):
+    """
+    Prefix tree of labels, used to complete and check labels as they are typed.
+
+    For example:::
+
+        labels = LabelTrie(["eq:ZE.EX.PR1", "eq:ZE.EX.PR2", "eq:ZE.DE.1"])
+
+        "eq:ZE.EX.PR2" in labels    #returns True
+        labels.keys("eq:ZE.EX")     #returns ["eq:ZE.EX.PR1", "eq:ZE.EX.PR2"]
+
+    """
+
+    def __init__(self, labels=()):
+
+        self.root = {}
+        self.size = 0
+
+        self._last_text = None
+        self._last_matches = []
+
+        for label in labels:
+            self.add(label)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, label):
+
+        node = self._find(label)
+
+        return node is not None and None in node
+
+    def add(self, label):
+        """
+        Adds `label` to the trie.
+        """
+
+        node = self.root
+
+        for char in label:
+            node = node.setdefault(char, {})
+
+        #None marks the end of a label
+        if None not in node:
+            node[None] = True
+            self.size += 1
+
+    def keys(self, prefix=""):
+        """
+        Returns a sorted list of every label that starts with `prefix`.
+        """
+
+        node = self._find(prefix)
+
+        if node is None:
+            return []
+
+        found = []
+        stack = [(prefix, node)]
+
+        #walk the subtree under the prefix
+        while stack:
+
+            text, node = stack.pop()
+
+            for char, child in node.items():
+
+                if char is None:
+                    found.append(text)
+                else:
+                    stack.append((text + char, child))
+
+        return sorted(found)
+
+    def complete(self, text, state):
+        """
+        Returns the `state`th label starting with `text` (in the form readline expects).
+        """
+
+        #readline asks for every state in turn, so only search once
+        if text != self._last_text:
+            self._last_text = text
+            self._last_matches = self.keys(text)
+
+        if state < len(self._last_matches):
+            return self._last_matches[state]
+
+        return None
+
+    #returns the node reached by following text from the root (or None)
+    def _find(self, text):
+
+        node = self.root
+
+        for char in text:
+
+            node = node.get(char)
+
+            if node is None:
+                return None
+
+        return node
+
+class SuggestionIndex(object):
+    """
+    Index of annotation texts, used to suggest the text of new annotations.
+
+    Texts are indexed by the character trigrams in them (ignoring
+    whitespace), so the texts that appear (nearly) word for word in a
+    line can be found without comparing the line to every text. The
+    words in the texts are also kept in a `LabelTrie`, to complete
+    annotations as they are typed.
+
+    For example:::
+
+        suggestions = SuggestionIndex(["$n \\geq 0$", "$\\realpart{s} > 1$"])
+
+        suggestions.suggest("When $n \\geq 0$ we have")     #returns ["$n \\geq 0$"]
+
+    """
+
+    #length of the pieces texts are indexed by
+    GRAM_SIZE = 3
+
+    #smallest fraction of a text's pieces that have to be in a line to suggest it
+    MIN_SCORE = 0.6
+
+    def __init__(self, texts=(), filename=None):
+
+        self.counts = {}
+        self.grams = {}
+        self.words = LabelTrie()
+        self.filename = filename
+
+        for text in texts:
+            self.add(text)
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Returns a `SuggestionIndex` of the texts in `filename` (one per line).
+
+        Texts given to `remember` are added to the end of the file, so
+        they are suggested in later sessions too. A missing file is
+        treated as an empty one.
+        """
+
+        try:
+            with open(filename) as in_file:
+                texts = [line.rstrip("\n") for line in in_file]
+        except IOError:
+            texts = []
+
+        return cls([text for text in texts if text.strip()], filename)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, text):
+        """
+        Adds `text` to the index (or counts it again if it is already there).
+        """
+
+        if text in self.counts:
+            self.counts[text] += 1
+            return
+
+        self.counts[text] = 1
+
+        for gram in self._grams(text):
+            self.grams.setdefault(gram, set()).add(text)
+
+        for word in text.split():
+            self.words.add(word)
+
+    def remember(self, text):
+        """
+        Adds `text` to the index and to the end of the file it was read from.
+        """
+
+        self.add(text)
+
+        if self.filename is not None:
+            writeout(self.filename, text + "\n", append=True)
+
+    def suggest(self, line, spans=(), limit=9):
+        """
+        Returns up to `limit` texts for an annotation on `line`, best first.
+
+        Every text in `spans` (such as the math in `line`) is suggested,
+        along with the indexed texts that are mostly made of pieces of
+        `line`. Texts that match more of `line`, then texts that have
+        been entered more often, are ranked first.
+        """
+
+        line_grams = self._grams(line)
+        hits = {}
+
+        #count the pieces of each text that are in the line
+        for gram in line_grams:
+            for text in self.grams.get(gram, ()):
+                hits[text] = hits.get(text, 0) + 1
+
+        scores = {}
+
+        for text, count in hits.items():
+
+            score = float(count) / len(self._grams(text))
+
+            if score >= self.MIN_SCORE:
+                scores[text] = score
+
+        for text in spans:
+            scores[text] = 1.0
+
+        ranked = sorted(scores, key=lambda text: (-scores[text], -self.counts.get(text, 0), text))
+
+        return ranked[:limit]
+
+    #returns the set of pieces of text that it is indexed by
+    def _grams(self, text):
+
+        text = "".join(text.split())
+
+        #short texts are indexed by themselves
+        if len(text) <= self.GRAM_SIZE:
+            return set([text])
+
+        return set(text[i:i + self.GRAM_SIZE] for i in xrange(len(text) - self.GRAM_SIZE + 1))
+
 class _Getch:
     """
     Gets a single character from standard input.  Does not echo to the screen.
@@ -304,4 +956,15 @@ class _GetchWindows:
         import msvcrt
         return msvcrt.getch()
 
-_getch = _Getch()
+#the terminal reader is only set up the first time a character is read
+_getch_impl = None
+
+#reads a single character from standard input
+def _getch():
+
+    global _getch_impl
+
+    if _getch_impl is None:
+        _getch_impl = _Getch()
+
+    return _getch_impl()
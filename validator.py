@@ -0,0 +1,211 @@
+"""
+Checks processed TeX for annotation comments that didn't end up where they should.
+
+The lines are read once, in order, and the following are reported
+along with the line they are on:
+
+* orphaned comments: comment lines meant to be inserted into an
+  equation that were left outside of it
+* duplicate insertions: the same annotation inserted into an equation
+  more than once
+* annotations whose braces aren't balanced
+* REM_START markers that are never closed (and REM_END markers that
+  were never opened)
+* annotations that were entered but aren't in their equation
+
+The module can also be run directly:
+
+    python validator.py texfile
+
+Which prints the problems with the annotations in the file.
+"""
+
+from __future__ import print_function
+
+import re
+import sys
+from collections import namedtuple
+
+from utilities import REM_START, REM_END
+
+#something wrong with the annotations (line is 0 when it isn't on any line)
+Problem = namedtuple("Problem", "line kind message")
+
+#matches the start of an equation along with its label
+_begin_pat = re.compile(r'\\begin{equation}(?:\\label{(?P<label>[^}]*)})?')
+
+#matches an annotation comment inside an equation
+_comment_pat = re.compile(r'^\s*%\s*\\(?P<name>constraint|substitution|drmfname|drmfnote|proof){(?P<annotation>.*)}\s*$')
+
+#matches a comment line that should have been inserted into an equation
+_orphan_pat = re.compile(r'^(?:\d+:)?{(?P<label>[^}]*)}%\s*\\(?P<name>\w+){(?P<annotation>.*)}\s*$')
+
+#matches a brace or an escaped character
+_brace_pat = re.compile(r'\\.|[{}]')
+
+#matches either marker
+_marker_pat = re.compile(re.escape(REM_START) + "|" + re.escape(REM_END))
+
+def main():
+
+    if len(sys.argv) != 2:
+
+        print("Usage: {0} <texfile>".format(sys.argv[0]))
+        sys.exit(-1)
+
+    with open(sys.argv[1]) as in_file:
+        problems = validate(in_file)
+
+    print(format_problems(problems) or "No problems found")
+
+    if problems:
+        sys.exit(1)
+
+def validate(lines, expected=()):
+    """
+    Returns a list of the `Problem`s with the annotations in `lines`.
+
+    `lines` can be any iterable of the lines of a document (such as
+    an open file), and is only read once. `expected` is an iterable
+    of (label, name, annotation) tuples of the annotations that should
+    be in the document, e.g. ("eq:ZE.EX.PR2", "constraint", "$n > 0$").
+    """
+
+    problems = []
+
+    #line each label is on, and the annotations in the equation
+    equations = {}
+
+    #annotations seen outside of their equations
+    orphaned = set()
+
+    label = None
+    eq_line = 0
+    in_eq = False
+
+    open_marker = 0
+
+    for line_num, line in enumerate(lines, 1):
+
+        line = line.rstrip("\n")
+
+        #report markers that are opened twice or closed without being opened
+        for match in _marker_pat.finditer(line):
+
+            if match.group() == REM_START:
+
+                if open_marker:
+                    problems.append(Problem(open_marker, "marker", "REM_START is never closed"))
+
+                open_marker = line_num
+
+            else:
+
+                if not open_marker:
+                    problems.append(Problem(line_num, "marker", "REM_END without a REM_START"))
+
+                open_marker = 0
+
+        begin_match = _begin_pat.search(line)
+
+        if begin_match:
+
+            in_eq = True
+            label = begin_match.group("label")
+            eq_line = line_num
+
+            if label is not None and label not in equations:
+                equations[label] = (line_num, set())
+
+        if in_eq:
+
+            comment_match = _comment_pat.match(line)
+
+            if comment_match:
+
+                annotation = comment_match.group("annotation")
+
+                if not _balanced(annotation):
+                    problems.append(Problem(line_num, "braces", "unbalanced braces in {0}".format(annotation)))
+
+                #only the first equation with a label is checked
+                if label is not None and equations[label][0] == eq_line:
+
+                    found = equations[label][1]
+                    key = (comment_match.group("name"), annotation)
+
+                    if key in found:
+                        problems.append(Problem(line_num, "duplicate", "{0}{{{1}}} is in {2} more than once".format(key[0], key[1], label)))
+
+                    found.add(key)
+
+        else:
+
+            orphan_match = _orphan_pat.match(line)
+
+            if orphan_match:
+
+                key = orphan_match.group("label", "name", "annotation")
+                orphaned.add(key)
+
+                problems.append(Problem(line_num, "orphan", "{1}{{{2}}} was not inserted into {0}".format(*key)))
+
+                if not _balanced(key[2]):
+                    problems.append(Problem(line_num, "braces", "unbalanced braces in {0}".format(key[2])))
+
+        if r'\end{equation}' in line:
+            in_eq = False
+            label = None
+
+    if open_marker:
+        problems.append(Problem(open_marker, "marker", "REM_START is never closed"))
+
+    #every annotation that was entered should be in its equation
+    for label, name, annotation in expected:
+
+        if (label, name, annotation) in orphaned:
+            continue
+
+        if label not in equations:
+            problems.append(Problem(0, "missing", "there is no equation {0} for {1}{{{2}}}".format(label, name, annotation)))
+
+        elif (name, annotation) not in equations[label][1]:
+            problems.append(Problem(equations[label][0], "missing", "{0}{{{1}}} is not in {2}".format(name, annotation, label)))
+
+    return sorted(problems)
+
+def format_problems(problems):
+    """
+    Returns a report of `problems`, one per line (or an empty string if there are none).
+    """
+
+    rows = []
+
+    for problem in problems:
+
+        location = "line {0}".format(problem.line) if problem.line else "-"
+        rows.append("\t{0:<12}{1:<11}{2}".format(location, problem.kind, problem.message))
+
+    return "\n".join(rows)
+
+#returns True if every (unescaped) brace in text is closed, in order
+def _balanced(text):
+
+    depth = 0
+
+    for match in _brace_pat.finditer(text):
+
+        if match.group() == "{":
+            depth += 1
+
+        elif match.group() == "}":
+
+            depth -= 1
+
+            if depth < 0:
+                return False
+
+    return depth == 0
+
+if __name__ == "__main__":
+    main()